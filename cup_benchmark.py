@@ -0,0 +1,370 @@
+"""
+杯贴图像处理基准测试
+覆盖源图加载、process_image 的各阶段与各模式、批量处理、打印预览，以及 GUI 的 cup_render（无界面 Tk 替身），
+源图分 small（PNG）、12mp、48mp（JPEG）三档，报告耗时、tracemalloc 峰值内存和每秒杯贴数；
+结果写成 JSON，可与保存的基线比较，超过阈值的变慢/变大记为回归
+
+用法:
+    python cup_benchmark.py -o result.json
+    python cup_benchmark.py --baseline result.json --threshold 0.2
+"""
+
+import argparse
+import io
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import PIL
+from PIL import Image
+
+import cup_image_processor as cip
+
+CANVAS_WIDTH = 596
+CANVAS_HEIGHT = 832
+
+# 源图档位：(宽, 高, 格式)
+SOURCE_SIZES = {
+    'small': (800, 600, 'PNG'),
+    '12mp': (4000, 3000, 'JPEG'),
+    '48mp': (8000, 6000, 'JPEG'),
+}
+
+# 每个模式的代表参数（与 GUI 默认值一致）
+DEFAULT_PARAMS = dict(
+    canvas_width=CANVAS_WIDTH,
+    canvas_height=CANVAS_HEIGHT,
+    scale_percent=100,
+    grid_size=4,
+    shape='circle',
+    angle=45,
+    gamma=1.0,
+    contrast=0,
+    edge_protect=False,
+    lo_threshold=40,
+    hi_threshold=120,
+    tau_threshold=60,
+    dilate_iters=0,
+    fs_serpentine=True,
+)
+
+# (名称, 模式, 形状)
+MODES = ([(mode, mode, 'circle') for mode in cip.BAYER_MODES] +
+         [('bluenoise', 'bluenoise', 'circle')] +
+         [(mode, mode, 'circle') for mode in cip.DIFFUSION_MODES] +
+         [('circle', 'circle', 'circle'), ('square', 'circle', 'square'), ('cross', 'circle', 'cross'),
+          ('auto', 'auto', 'circle')])
+
+BATCH_SIZE = 16
+DEFAULT_THRESHOLD = 0.2
+
+
+def synthetic_source(width: int, height: int, fmt: str, seed: int = 0) -> bytes:
+    """
+    生成照片般的合成源图（平滑的色块渐变 + 颗粒噪声）并编码，确保各次运行的输入一致
+    """
+    rng = np.random.default_rng(seed)
+    small = Image.fromarray(rng.integers(0, 256, (12, 16, 3), dtype=np.uint8))
+    img = small.resize((width, height), Image.Resampling.BICUBIC)
+    
+    # 叠加高频细节，避免编码后过于平滑
+    noise = rng.integers(0, 24, (height, width, 1), dtype=np.uint8)
+    arr = np.asarray(img).copy()
+    arr //= 2
+    arr += noise
+    img = Image.fromarray(arr)
+    
+    buf = io.BytesIO()
+    img.save(buf, fmt, **({'quality': 90} if fmt == 'JPEG' else {}))
+    return buf.getvalue()
+
+
+def measure(fn, repeat: int, warmup: int = 1, memory: bool = True) -> dict:
+    """
+    运行 fn：先预热，再计时 repeat 次；另外单独跑一次统计 tracemalloc 峰值
+    （只统计经 Python/NumPy 分配的内存，Pillow 内部的图像缓冲区不计入）
+    """
+    for _ in range(warmup):
+        fn()
+    
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    
+    result = {
+        'repeat': repeat,
+        'min_s': min(times),
+        'median_s': statistics.median(times),
+        'mean_s': statistics.fmean(times),
+    }
+    
+    if memory:
+        tracemalloc.start()
+        try:
+            fn()
+            result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def _headless_uploader(source):
+    """
+    不创建 Tk 窗口的 HeyTeaUploader 替身：跳过 __init__，只设置 cup_render 用到的属性；
+    画布、标签、PhotoImage 换成只记录参数的对象，因此不计 Tk 本身的绘制时间
+    """
+    import main
+    
+    class Var:
+        def __init__(self, value):
+            self.value = value
+        
+        def get(self):
+            return self.value
+    
+    class Widget:
+        def itemconfig(self, *args, **kwargs):
+            pass
+        
+        config = itemconfig
+    
+    class PhotoImage:
+        def __init__(self, image):
+            self.image = image
+    
+    class Messagebox:
+        @staticmethod
+        def showerror(title, message):
+            raise RuntimeError(message)
+    
+    main.ImageTk = type('ImageTk', (), {'PhotoImage': PhotoImage})
+    main.messagebox = Messagebox
+    
+    app = object.__new__(main.HeyTeaUploader)
+    app.cup_current_image = source
+    app.cup_pipeline = cip.RenderPipeline()
+    app.cup_render_cache = None
+    app.cup_render_token = 0
+    app.cup_auto_busy = False
+    app.cup_auto_request = None
+    app.cup_canvas_images = {}
+    app.cup_preview_canvas = app.cup_print_canvas = app.cup_status_label = Widget()
+    app.cup_canvas_item = app.cup_print_item = None
+    app.cup_mode_var = Var('circle')
+    app.cup_scale_var = Var(DEFAULT_PARAMS['scale_percent'])
+    app.cup_grid_var = Var(DEFAULT_PARAMS['grid_size'])
+    app.cup_shape_var = Var(DEFAULT_PARAMS['shape'])
+    app.cup_angle_var = Var(DEFAULT_PARAMS['angle'])
+    app.cup_gamma_var = Var(DEFAULT_PARAMS['gamma'])
+    app.cup_contrast_var = Var(DEFAULT_PARAMS['contrast'])
+    app.cup_edge_var = Var(DEFAULT_PARAMS['edge_protect'])
+    app.cup_lo_var = Var(DEFAULT_PARAMS['lo_threshold'])
+    return app
+
+
+def _cases(sizes: list, include_gui: bool) -> list:
+    """
+    全部基准项：[(名称, 每次处理的杯贴数, 准备函数)]；准备函数返回待计时的无参函数
+    （名称形如 组/项@档位，canvas 档位表示与源图分辨率无关的画布级阶段）
+    """
+    cases = []
+    sources = {}
+    
+    def source(size):
+        if size not in sources:
+            width, height, fmt = SOURCE_SIZES[size]
+            data = synthetic_source(width, height, fmt)
+            image = cip.load_source_image(io.BytesIO(data), CANVAS_WIDTH, CANVAS_HEIGHT, cip.MAX_SCALE_PERCENT)
+            sources[size] = (data, cip.SourcePyramid(image, CANVAS_WIDTH, CANVAS_HEIGHT, cip.MIN_SCALE_PERCENT))
+        return sources[size]
+    
+    def canvas():
+        return cip.scale_image_to_canvas(source(sizes[0])[1], CANVAS_WIDTH, CANVAS_HEIGHT, 100)[0]
+    
+    def gray():
+        return cip.to_adjusted_grayscale(canvas(), DEFAULT_PARAMS['contrast'], DEFAULT_PARAMS['gamma'])
+    
+    def dithered():
+        g = gray()
+        return cip.dither_bayer(g), g
+    
+    def sticker():
+        return cip.PackedSticker.from_array(dithered()[0])
+    
+    def render(name, stickers, size, fn):
+        # fn(源图金字塔)
+        def prepare():
+            src = source(size)[1]
+            return lambda: fn(src)
+        cases.append((name, stickers, prepare))
+    
+    def load(size):
+        def prepare():
+            data = source(size)[0]
+            return lambda: cip.SourcePyramid(
+                cip.load_source_image(io.BytesIO(data), CANVAS_WIDTH, CANVAS_HEIGHT, cip.MAX_SCALE_PERCENT),
+                CANVAS_WIDTH, CANVAS_HEIGHT, cip.MIN_SCALE_PERCENT)
+        cases.append((f'load/decode@{size}', 0, prepare))
+    
+    # 源图加载、缩放与整条处理链（每个源图档位）
+    batch_params = {k: v for k, v in DEFAULT_PARAMS.items() if k not in ('canvas_width', 'canvas_height')}
+    for size in sizes:
+        load(size)
+        render(f'stage/scale@{size}', 0, size,
+               lambda src: cip.scale_image_to_canvas(src, CANVAS_WIDTH, CANVAS_HEIGHT, 100))
+        for name, mode, shape in MODES:
+            params = dict(DEFAULT_PARAMS, mode=mode, shape=shape)
+            render(f'process_image/{name}@{size}', 1, size,
+                   lambda src, params=params: cip.process_image(src, **params, packed=True))
+        render(f'process_image/circle+edge@{size}', 1, size, lambda src: cip.process_image(
+            src, **dict(DEFAULT_PARAMS, mode='circle', edge_protect=True, dilate_iters=1), packed=True))
+        render(f'process_image/fs+stream@{size}', 1, size, lambda src: cip.process_image(
+            src, **dict(DEFAULT_PARAMS, mode='fs'), packed=True, memory_budget=32 * 1024 * 1024))
+        render(f'process_images/bayer@{size}', BATCH_SIZE, size, lambda src: cip.process_images(
+            [src] * BATCH_SIZE, 'bayer', CANVAS_WIDTH, CANVAS_HEIGHT, **batch_params, packed=True))
+    
+    # 画布级的各阶段（与源图分辨率无关）
+    def stage(name, fn, make_input):
+        def prepare():
+            args = make_input()
+            return lambda: fn(*args)
+        cases.append((f'{name}@canvas', 0, prepare))
+    
+    stage('stage/grayscale', cip.to_grayscale, lambda: (canvas(),))
+    stage('stage/grayscale+lut', cip.to_adjusted_grayscale, lambda: (canvas(), 20, 1.2))
+    for name, mode, shape in MODES:
+        if mode != 'auto':
+            stage(f'stage/binarize-{name}', cip.binarize, lambda mode=mode, shape=shape: (
+                gray(), mode, CANVAS_WIDTH, CANVAS_HEIGHT, DEFAULT_PARAMS['grid_size'], shape,
+                DEFAULT_PARAMS['angle']))
+    stage('stage/sobel', cip.sobel_magnitude, lambda: (gray(),))
+    stage('stage/edge-protect', cip.apply_edge_protection, lambda: dithered() + (40, 120, 60, 1))
+    stage('stage/auto-metric', cip.blurred_error, dithered)
+    stage('preview/downsample', cip.downsample_preview, lambda: (sticker(),))
+    stage('preview/print_preview', cip.generate_print_preview, lambda: (sticker(),))
+    
+    # GUI 渲染路径：每次换一个 Gamma，阶段缓存只命中缩放和灰度，与拖动滑块时相同
+    if include_gui:
+        def gui_case(size):
+            app = _headless_uploader(source(size)[1])
+            gammas = itertools.cycle(np.linspace(0.8, 1.2, 7).tolist())
+            
+            def step():
+                app.cup_gamma_var.value = next(gammas)
+                app.cup_render()
+            return step
+        for size in sizes:
+            cases.append((f'gui/cup_render@{size}', 1, lambda size=size: gui_case(size)))
+    
+    return cases
+
+
+def run_benchmarks(sizes: list = None, repeat: int = 5, pattern: str = None,
+                   include_gui: bool = True, memory: bool = True, log=print) -> dict:
+    """
+    运行基准测试，返回可写成 JSON 的结果（meta + 各项的耗时、峰值内存、吞吐量）
+    pattern: 只运行名称中含该子串的项
+    """
+    sizes = sizes or list(SOURCE_SIZES)
+    results = {}
+    for name, stickers, prepare in _cases(sizes, include_gui):
+        if pattern and pattern not in name:
+            continue
+        try:
+            fn = prepare()
+        except ImportError as e:
+            # 例如 GUI 依赖未安装
+            results[name] = {'skipped': str(e)}
+            log(f"{name:44s} 跳过: {e}")
+            continue
+        
+        result = measure(fn, repeat, memory=memory)
+        if stickers:
+            result['stickers_per_s'] = stickers / result['median_s']
+        results[name] = result
+        peak = f"{result['peak_bytes'] / 2 ** 20:8.1f} MiB" if 'peak_bytes' in result else ''
+        rate = f"{result['stickers_per_s']:8.1f} 张/秒" if stickers else ''
+        log(f"{name:44s} {result['median_s'] * 1000:9.2f} ms {peak} {rate}")
+    
+    meta = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pillow': PIL.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'kernel_backends': cip.kernel_backends(),
+        'canvas': [CANVAS_WIDTH, CANVAS_HEIGHT],
+        'sizes': {size: list(SOURCE_SIZES[size][:2]) for size in sizes},
+    }
+    return {'meta': meta, 'results': results}
+
+
+def compare(current: dict, baseline: dict, threshold: float = DEFAULT_THRESHOLD) -> list:
+    """
+    与基线比较：中位耗时或峰值内存超过基线 (1 + threshold) 倍的项记为回归
+    返回 [(名称, 指标, 基线值, 当前值, 比值), ...]
+    """
+    regressions = []
+    for name, result in current['results'].items():
+        base = baseline.get('results', {}).get(name)
+        if not base or 'skipped' in result or 'skipped' in base:
+            continue
+        for metric in ('median_s', 'peak_bytes'):
+            if metric in result and base.get(metric):
+                ratio = result[metric] / base[metric]
+                if ratio > 1 + threshold:
+                    regressions.append((name, metric, base[metric], result[metric], ratio))
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="杯贴图像处理基准测试")
+    parser.add_argument('-o', '--output', help="结果 JSON 的保存路径")
+    parser.add_argument('--baseline', help="与之比较的基线 JSON")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="回归阈值（相对基线变慢/变大的比例，默认 0.2）")
+    parser.add_argument('--sizes', default=','.join(SOURCE_SIZES),
+                        help="源图档位，逗号分隔（small,12mp,48mp）")
+    parser.add_argument('--repeat', type=int, default=5, help="每项计时次数")
+    parser.add_argument('-k', '--filter', help="只运行名称中含该子串的项")
+    parser.add_argument('--backend', choices=cip.KERNEL_BACKENDS, help="内核后端（默认自动选择）")
+    parser.add_argument('--no-gui', action='store_true', help="跳过 cup_render")
+    parser.add_argument('--no-memory', action='store_true', help="不统计 tracemalloc 峰值（更快）")
+    args = parser.parse_args(argv)
+    
+    sizes = [s for s in args.sizes.split(',') if s]
+    unknown = set(sizes) - set(SOURCE_SIZES)
+    if unknown:
+        parser.error(f"未知的源图档位: {', '.join(sorted(unknown))}")
+    if args.backend:
+        cip.select_backend(args.backend)
+    
+    current = run_benchmarks(sizes, args.repeat, args.filter, not args.no_gui, not args.no_memory)
+    
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(current, f, indent=2, ensure_ascii=False)
+    
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.threshold)
+        for name, metric, base, value, ratio in regressions:
+            print(f"回归: {name} {metric} {base:.6g} -> {value:.6g} (x{ratio:.2f})")
+        if regressions:
+            return 1
+        print(f"与基线相比没有超过 {args.threshold:.0%} 的回归")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
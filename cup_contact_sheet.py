@@ -0,0 +1,148 @@
+"""
+杯贴参数扫描对比图
+对一张源图按网格大小、角度、Gamma、对比度、更黑阈值的取值范围渲染全部组合，拼成一张对比图；
+缩放后的画布只放进 multiprocessing.shared_memory 一次，工作进程直接映射读取，不经 pickle 传送
+"""
+
+import itertools
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import shared_memory
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from cup_image_processor import (apply_edge_protection, binarize, gamma_contrast_lut,
+                                 scale_image_to_canvas, sobel_magnitude, to_grayscale)
+
+# 可扫描的参数，及对比图标注中的简写
+SWEEP_PARAMS = ('grid_size', 'angle', 'gamma', 'contrast', 'lo_threshold')
+_CAPTION_NAMES = {'grid_size': 'g', 'angle': 'a', 'gamma': 'gm', 'contrast': 'c', 'lo_threshold': 'lo'}
+
+THUMB_WIDTH = 149  # 596 的 1/4
+CAPTION_HEIGHT = 14
+SHEET_GAP = 4
+
+# 工作进程中当前映射的共享画布，以及按 (对比度, gamma) 缓存的调整后灰度和 Sobel 边缘图
+_shared = None
+_adjusted = None
+
+
+def _attach_canvas(name: str, shape: tuple) -> np.ndarray:
+    """
+    映射主进程放入共享内存的画布（只保留最近一次的映射，进程池可跨多张对比图复用）
+    """
+    global _shared, _adjusted
+    if _shared is None or _shared[0].name != name:
+        if _shared is not None:
+            _shared[0].close()
+        shm = shared_memory.SharedMemory(name=name)
+        _shared = (shm, np.ndarray(shape, dtype=np.uint8, buffer=shm.buf))
+        _adjusted = None
+    return _shared[1]
+
+
+def _render_thumbnail(name: str, shape: tuple, params: dict, thumb_size: tuple, combo: dict) -> np.ndarray:
+    """
+    工作进程：按 params 中被 combo 覆盖后的参数渲染一格，返回缩略图（8 位灰度数组）
+    """
+    global _adjusted
+    canvas = _attach_canvas(name, shape)
+    p = dict(params, **combo)
+    h, w = shape[:2]
+    
+    # 组合按 Gamma/对比度在外层排列，同一进程连续拿到的组合大多可以复用调整后的灰度
+    key = (p['contrast'], p['gamma'])
+    if _adjusted is None or _adjusted[0] != key:
+        _adjusted = (key, to_grayscale(canvas, gamma_contrast_lut(p['contrast'], p['gamma'])), None)
+    gray, edge = _adjusted[1], _adjusted[2]
+    
+    binary = binarize(gray, p['mode'], w, h, p['grid_size'], p['shape'], p['angle'], p['fs_serpentine'])
+    if p['edge_protect']:
+        if edge is None:
+            edge = sobel_magnitude(gray)
+            _adjusted = (key, gray, edge)
+        binary = apply_edge_protection(binary, gray, p['lo_threshold'], p['hi_threshold'],
+                                       p['tau_threshold'], p['dilate_iters'], edge)
+    
+    return np.asarray(Image.fromarray(binary).resize(thumb_size, Image.Resampling.LANCZOS))
+
+
+def sweep_combinations(ranges: dict) -> list:
+    """
+    参数组合列表 [{参数: 值, ...}, ...]，Gamma、对比度在最外层，其后依次为网格大小、角度、更黑阈值
+    ranges 中未给出的参数不扫描
+    """
+    order = [name for name in ('gamma', 'contrast', 'grid_size', 'angle', 'lo_threshold') if name in ranges]
+    unknown = set(ranges) - set(SWEEP_PARAMS)
+    if unknown:
+        raise ValueError(f"不支持扫描的参数: {', '.join(sorted(unknown))}")
+    return [dict(zip(order, values)) for values in itertools.product(*(ranges[name] for name in order))]
+
+
+def _caption(combo: dict) -> str:
+    parts = []
+    for name in SWEEP_PARAMS:
+        if name in combo:
+            value = combo[name]
+            parts.append(f"{_CAPTION_NAMES[name]}{value:.2f}" if isinstance(value, float)
+                         else f"{_CAPTION_NAMES[name]}{value}")
+    return ' '.join(parts)
+
+
+def render_contact_sheet(image, params: dict, ranges: dict, processes: int = None,
+                         executor: ProcessPoolExecutor = None, columns: int = None,
+                         thumb_width: int = THUMB_WIDTH, canvas: np.ndarray = None) -> tuple:
+    """
+    参数扫描对比图
+    image: PIL 图像或 SourcePyramid；params: 同 process_image 的参数（mode、canvas_width 等）；
+    ranges: {参数名: 取值序列}，参数名取自 SWEEP_PARAMS，其余参数固定为 params 中的值
+    processes: 新建进程池的进程数（默认 CPU 核数）；executor: 指定进程池（可跨多次调用复用）
+    columns: 每行格数，默认接近正方形
+    canvas: 已按 params 缩放好的画布数组（给出时不再缩放 image，如 GUI 在界面线程中先缩放好，
+    后台线程不再碰与界面共用的源图）
+    
+    返回: (对比图 'L' 图像, 与各格一一对应的参数组合列表)
+    """
+    combos = sweep_combinations(ranges)
+    if not combos:
+        raise ValueError("扫描范围为空")
+    
+    if canvas is None:
+        canvas, _, _, _ = scale_image_to_canvas(
+            image, params['canvas_width'], params['canvas_height'], params['scale_percent'])
+    h, w = canvas.shape[:2]
+    thumb_size = (thumb_width, max(1, round(thumb_width * h / w)))
+    
+    shm = shared_memory.SharedMemory(create=True, size=canvas.nbytes)
+    try:
+        np.ndarray(canvas.shape, dtype=np.uint8, buffer=shm.buf)[:] = canvas
+        render = partial(_render_thumbnail, shm.name, canvas.shape, params, thumb_size)
+        
+        processes = processes or os.cpu_count() or 1
+        chunksize = max(1, len(combos) // (processes * 4))
+        if executor is None:
+            with ProcessPoolExecutor(min(processes, len(combos))) as pool:
+                thumbs = list(pool.map(render, combos, chunksize=chunksize))
+        else:
+            thumbs = list(executor.map(render, combos, chunksize=chunksize))
+    finally:
+        shm.close()
+        shm.unlink()
+    
+    # 拼图：每格为缩略图 + 下方的参数标注
+    columns = columns or math.ceil(math.sqrt(len(combos)))
+    rows = math.ceil(len(combos) / columns)
+    cell_w, cell_h = thumb_size[0] + SHEET_GAP, thumb_size[1] + CAPTION_HEIGHT + SHEET_GAP
+    sheet = Image.new('L', (columns * cell_w + SHEET_GAP, rows * cell_h + SHEET_GAP), 200)
+    draw = ImageDraw.Draw(sheet)
+    font = ImageFont.load_default()
+    for index, (thumb, combo) in enumerate(zip(thumbs, combos)):
+        x = SHEET_GAP + (index % columns) * cell_w
+        y = SHEET_GAP + (index // columns) * cell_h
+        sheet.paste(Image.fromarray(thumb), (x, y))
+        draw.text((x + 1, y + thumb_size[1] + 1), _caption(combo), fill=0, font=font)
+    
+    return sheet, combos
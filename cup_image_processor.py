@@ -4,8 +4,20 @@
 """
 
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+from functools import lru_cache
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+import contextvars
 import io
+import itertools
+import os
+import threading
+import time
+import warnings
+
+import cup_kernels
+from cup_profiling import stage_clock, stage_timings, timed
 
 # Bayer 8x8 阈值表 (0..63)
 BAYER8 = np.array([
@@ -19,14 +31,289 @@ BAYER8 = np.array([
     [63, 31, 55, 23, 61, 29, 53, 21],
 ], dtype=np.uint8)
 
+# 图像缩放滑块的范围（%）：上限决定源图解码时最多能缩小到多少，下限决定金字塔建到哪一级
+MIN_SCALE_PERCENT = 25
+MAX_SCALE_PERCENT = 300
 
-def scale_image_to_canvas(image: Image.Image, canvas_width: int, canvas_height: int, scale_percent: float) -> tuple:
+# 有序抖动模式 -> Bayer 矩阵尺寸（'bayer' 保持原来的 8x8）
+BAYER_MODES = {
+    'bayer': 8,
+    'bayer4': 4,
+    'bayer8': 8,
+    'bayer16': 16,
+    'bayer32': 32,
+}
+
+# 误差扩散核：((dx, dy, 权重分子), ...), 分母
+# dx 以扫描方向为正，蛇形扫描的反向行自动镜像
+DIFFUSION_KERNELS = {
+    'floyd-steinberg': (((1, 0, 7),
+                         (-1, 1, 3), (0, 1, 5), (1, 1, 1)), 16),
+    'atkinson': (((1, 0, 1), (2, 0, 1),
+                  (-1, 1, 1), (0, 1, 1), (1, 1, 1),
+                  (0, 2, 1)), 8),
+    'jarvis': (((1, 0, 7), (2, 0, 5),
+                (-2, 1, 3), (-1, 1, 5), (0, 1, 7), (1, 1, 5), (2, 1, 3),
+                (-2, 2, 1), (-1, 2, 3), (0, 2, 5), (1, 2, 3), (2, 2, 1)), 48),
+    'stucki': (((1, 0, 8), (2, 0, 4),
+                (-2, 1, 2), (-1, 1, 4), (0, 1, 8), (1, 1, 4), (2, 1, 2),
+                (-2, 2, 1), (-1, 2, 2), (0, 2, 4), (1, 2, 2), (2, 2, 1)), 42),
+    'sierra': (((1, 0, 5), (2, 0, 3),
+                (-2, 1, 2), (-1, 1, 4), (0, 1, 5), (1, 1, 4), (2, 1, 2),
+                (-1, 2, 2), (0, 2, 3), (1, 2, 2)), 32),
+}
+
+# 误差扩散模式 -> 扩散核名称（'fs' 保持原来的 Floyd-Steinberg）
+DIFFUSION_MODES = {
+    'fs': 'floyd-steinberg',
+    'atkinson': 'atkinson',
+    'jarvis': 'jarvis',
+    'stucki': 'stucki',
+    'sierra': 'sierra',
+}
+
+# 蓝噪声阈值图（void-and-cluster），生成一次后以 .npy 保存在模块旁边
+BLUE_NOISE_SIZE = 64
+_MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+_blue_noise_tiles = {}
+
+# 内核后端：每个内核有 reference（逐像素参考实现）、numpy（整幅向量化）和可选的 numba（编译）实现
+# 导入时自动选择（有 Numba 用 numba，否则 numpy），可用环境变量 CUP_KERNEL_BACKEND 或 select_backend() 指定
+KERNEL_BACKENDS = ('numba', 'numpy', 'reference')
+KERNEL_BACKEND_ENV = 'CUP_KERNEL_BACKEND'
+# 向量化版本已比逐像素编译版本快的内核，自动选择时保留 numpy
+_AUTO_PREFER_NUMPY = frozenset({'dilate'})
+_kernel_impls = {}     # 内核名 -> {后端名: 实现}
+_active_kernels = {}   # 内核名 -> 当前实现
+_active_backends = {}  # 内核名 -> 当前后端名
+
+
+def register_kernel(name: str, backend: str):
     """
-    根据缩放百分比将图像缩放并居中放置到画布中
-    返回 (缩放后图像数组, 原始宽度, 原始高度, 实际缩放比例)
+    装饰器：登记内核 name 在 backend 后端下的实现（与对应的公开函数参数相同）
     """
-    img_w, img_h = image.size
+    def decorator(fn):
+        _kernel_impls.setdefault(name, {})[backend] = fn
+        return fn
+    return decorator
+
+
+def select_backend(backend: str = None) -> dict:
+    """
+    为所有内核选择后端；backend 为 None 时读环境变量（取值无效时警告），仍未指定则自动选择
+    指定的后端缺少某个内核（如未安装 Numba）时该内核退回 numpy
+    返回 {内核名: 实际使用的后端}
+    """
+    if backend is None:
+        backend = os.environ.get(KERNEL_BACKEND_ENV) or None
+        # 环境变量写错不应让模块（以及整个程序）无法导入：警告后自动选择
+        if backend is not None and backend not in KERNEL_BACKENDS:
+            warnings.warn(f"环境变量 {KERNEL_BACKEND_ENV} 指定了未知的内核后端: {backend}"
+                          f"（可选 {', '.join(KERNEL_BACKENDS)}），改为自动选择")
+            backend = None
+    elif backend not in KERNEL_BACKENDS:
+        raise ValueError(f"未知的内核后端: {backend}（可选 {', '.join(KERNEL_BACKENDS)}）")
+    
+    for name, impls in _kernel_impls.items():
+        if backend is None:
+            chosen = 'numba' if 'numba' in impls and name not in _AUTO_PREFER_NUMPY else 'numpy'
+        else:
+            chosen = backend if backend in impls else 'numpy'
+        _active_kernels[name] = impls[chosen]
+        _active_backends[name] = chosen
+    return dict(_active_backends)
+
+
+def kernel_backends() -> dict:
+    """当前各内核使用的后端"""
+    return dict(_active_backends)
+
+
+def _kernel(name: str):
+    return _active_kernels[name]
+
+
+def bayer_matrix(n: int) -> np.ndarray:
+    """
+    递归生成 n×n Bayer 矩阵（n 为 2 的幂），取值 0..n*n-1
+    """
+    if n < 2 or n & (n - 1):
+        raise ValueError(f"Bayer 矩阵尺寸必须是 2 的幂: {n}")
+    
+    m = np.zeros((1, 1), dtype=np.int32)
+    while m.shape[0] < n:
+        m = np.block([[4 * m, 4 * m + 2],
+                      [4 * m + 3, 4 * m + 1]])
+    return m
+
+
+def _tile_threshold_plane(ranks: np.ndarray, height: int, width: int) -> np.ndarray:
+    """
+    将排名矩阵 (0..n-1) 平铺成 height×width 的阈值平面 (0..255)，返回只读数组
+    """
+    th, tw = ranks.shape
+    # (rank + 0.5) * 256 / n ，Bayer 8x8 时即原来的 (BAYER8 + 0.5) * 4
+    tile = ((ranks + 0.5) * (256.0 / ranks.size)).astype(np.float32)
+    reps_y = -(-height // th)
+    reps_x = -(-width // tw)
+    plane = np.tile(tile, (reps_y, reps_x))[:height, :width].copy()
+    plane.setflags(write=False)
+    return plane
+
+
+@lru_cache(maxsize=16)
+def bayer_threshold_plane(n: int, height: int, width: int) -> np.ndarray:
+    """
+    将 n×n Bayer 矩阵平铺成 height×width 的阈值平面 (0..255)
+    按画布尺寸缓存，返回只读数组
+    """
+    return _tile_threshold_plane(bayer_matrix(n), height, width)
+
+
+def generate_blue_noise(size: int = BLUE_NOISE_SIZE, sigma: float = 1.5, seed: int = 0) -> np.ndarray:
+    """
+    void-and-cluster 算法生成 size×size 蓝噪声排名矩阵，取值 0..size*size-1
+    耗时较长，正常情况下只在 .npy 缺失时调用一次
+    """
+    n = size * size
+    
+    # 环形高斯核（中心在 (0, 0)），平移即得到任意点的能量贡献
+    d = np.minimum(np.arange(size), size - np.arange(size))
+    g1 = np.exp(-(d ** 2) / (2.0 * sigma ** 2))
+    kernel = np.outer(g1, g1)
+    
+    def splat(energy, idx, sign):
+        y, x = divmod(int(idx), size)
+        energy += sign * np.roll(kernel, (y, x), axis=(0, 1))
+    
+    # 1. 随机初始图案（约10%为1）
+    rng = np.random.default_rng(seed)
+    ones = n // 10
+    pattern = np.zeros(n, dtype=bool)
+    pattern[rng.choice(n, ones, replace=False)] = True
+    pattern = pattern.reshape(size, size)
+    energy = np.fft.irfft2(np.fft.rfft2(pattern.astype(np.float64)) * np.fft.rfft2(kernel), s=pattern.shape)
+    
+    # 2. 反复把最紧的簇移到最大的空洞，直到稳定
+    while True:
+        cluster = np.argmax(np.where(pattern, energy, -np.inf))
+        pattern.flat[cluster] = False
+        splat(energy, cluster, -1)
+        void = np.argmin(np.where(pattern, np.inf, energy))
+        pattern.flat[void] = True
+        splat(energy, void, 1)
+        if void == cluster:
+            break
+    
+    ranks = np.zeros(n, dtype=np.uint16)
+    
+    # 3. 从初始图案中逐个去掉最紧的簇，排名 ones-1 .. 0
+    p, e = pattern.copy(), energy.copy()
+    for rank in range(ones - 1, -1, -1):
+        idx = np.argmax(np.where(p, e, -np.inf))
+        p.flat[idx] = False
+        splat(e, idx, -1)
+        ranks[idx] = rank
     
+    # 4. 逐个填充最大的空洞，排名 ones .. n-1
+    p, e = pattern.copy(), energy.copy()
+    for rank in range(ones, n):
+        idx = np.argmin(np.where(p, np.inf, e))
+        p.flat[idx] = True
+        splat(e, idx, 1)
+        ranks[idx] = rank
+    
+    return ranks.reshape(size, size)
+
+
+def blue_noise_path(size: int = BLUE_NOISE_SIZE) -> str:
+    """
+    蓝噪声排名矩阵的 .npy 缓存路径（模块所在目录）
+    """
+    return os.path.join(_MODULE_DIR, f'bluenoise_{size}.npy')
+
+
+def load_blue_noise(size: int = BLUE_NOISE_SIZE, generate: bool = True) -> np.ndarray:
+    """
+    以内存映射方式加载蓝噪声排名矩阵
+    文件不存在时生成并写回磁盘（目录不可写时仅保留在内存中）
+    """
+    tile = _blue_noise_tiles.get(size)
+    if tile is not None:
+        return tile
+    
+    path = blue_noise_path(size)
+    try:
+        tile = np.load(path, mmap_mode='r')
+    except (OSError, ValueError):
+        if not generate:
+            return None
+        tile = generate_blue_noise(size)
+        try:
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                np.save(f, tile)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+    
+    _blue_noise_tiles[size] = tile
+    return tile
+
+
+@lru_cache(maxsize=16)
+def blue_noise_threshold_plane(size: int, height: int, width: int) -> np.ndarray:
+    """
+    将蓝噪声排名矩阵平铺成 height×width 的阈值平面 (0..255)
+    按画布尺寸缓存，返回只读数组
+    """
+    return _tile_threshold_plane(load_blue_noise(size), height, width)
+
+
+def load_source_image(fp, canvas_width: int = 596, canvas_height: int = 832,
+                      max_scale_percent: float = MAX_SCALE_PERCENT) -> Image.Image:
+    """
+    读取源图片作为工作副本：解码时直接缩小到在最大缩放比例下仍能铺满画布的最小尺寸
+    （JPEG 用 draft 模式按 1/2、1/4、1/8 解码，其他格式用 Image.reduce），并一次性应用 EXIF 方向
+    原图尺寸记录在 info['source_size']，scale_image_to_canvas 据此返回原始宽高和缩放比例
+    """
+    image = Image.open(fp)
+    
+    # EXIF 方向为 5..8 时宽高互换
+    orientation = image.getexif().get(0x0112, 1)
+    transposed = orientation in (5, 6, 7, 8)
+    stored_w, stored_h = image.size
+    src_w, src_h = (stored_h, stored_w) if transposed else (stored_w, stored_h)
+    
+    # 最大缩放比例下需要的尺寸（按存储方向）
+    need = min(canvas_width / src_w, canvas_height / src_h) * max_scale_percent / 100.0
+    if need < 1:
+        target_w = max(1, int(np.ceil(src_w * need)))
+        target_h = max(1, int(np.ceil(src_h * need)))
+        if transposed:
+            target_w, target_h = target_h, target_w
+        
+        if image.format == 'JPEG':
+            image.draft(image.mode, (target_w, target_h))
+            image.load()
+        else:
+            factor = min(stored_w // target_w, stored_h // target_h)
+            if factor >= 2:
+                if image.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+                    image = image.convert('RGB')
+                image = image.reduce(factor)
+    
+    image.load()
+    image = ImageOps.exif_transpose(image)
+    image.info['source_size'] = (src_w, src_h)
+    return image
+
+
+def _fit_size(img_w: int, img_h: int, canvas_width: int, canvas_height: int,
+              scale_percent: float) -> tuple:
+    """
+    缩放后的尺寸：先适应画布，再乘以用户指定的百分比，返回 (新宽, 新高, 缩放比例)
+    """
     # 计算基础缩放比例（使图像适应画布）
     base_scale = min(canvas_width / img_w, canvas_height / img_h)
     
@@ -37,213 +324,653 @@ def scale_image_to_canvas(image: Image.Image, canvas_width: int, canvas_height:
     # 计算新尺寸
     new_w = int(img_w * real_scale)
     new_h = int(img_h * real_scale)
+    return new_w, new_h, real_scale
+
+
+def _paste_centered(canvas: Image.Image, scaled_img: Image.Image):
+    """
+    将缩放后的图像居中粘贴到画布
+    """
+    offset_x = (canvas.width - scaled_img.width) // 2
+    offset_y = (canvas.height - scaled_img.height) // 2
+    canvas.paste(scaled_img, (offset_x, offset_y))
+
+
+def scale_image_to_canvas(image: Image.Image, canvas_width: int, canvas_height: int, scale_percent: float) -> tuple:
+    """
+    根据缩放百分比将图像缩放并居中放置到画布中
+    返回 (缩放后图像数组, 原始宽度, 原始高度, 实际缩放比例)
+    图像由 load_source_image 缩小过时，原始宽高与缩放比例仍相对原图
+    image 也可以是 SourcePyramid
+    """
+    canvas, src_w, src_h, real_scale = scale_image_to_canvas_image(image, canvas_width, canvas_height, scale_percent)
+    return np.asarray(canvas), src_w, src_h, real_scale
+
+
+def scale_image_to_canvas_image(image: Image.Image, canvas_width: int, canvas_height: int,
+                                scale_percent: float) -> tuple:
+    """
+    同 scale_image_to_canvas，但画布以 PIL 图像返回（流式处理时按行带读取，不整幅转为数组）
+    """
+    if isinstance(image, SourcePyramid):
+        return image.canvas_image(canvas_width, canvas_height, scale_percent)
+    
+    img_w, img_h = image.size
+    src_w, src_h = image.info.get('source_size', (img_w, img_h))
+    new_w, new_h, real_scale = _fit_size(img_w, img_h, canvas_width, canvas_height, scale_percent)
     
     # 缩放图像
     scaled_img = image.resize((new_w, new_h), Image.Resampling.LANCZOS)
     
-    # 创建白色背景画布
+    # 创建白色背景画布，居中粘贴
     canvas = Image.new('RGB', (canvas_width, canvas_height), 'white')
+    _paste_centered(canvas, scaled_img)
+    
+    return canvas, src_w, src_h, real_scale * img_w / src_w
+
+
+class SourcePyramid:
+    """
+    源图的多分辨率金字塔：第 0 级为工作副本，之后每级宽高减半（Image.reduce(2)），
+    一直建到最小缩放比例所需的尺寸；缩放时从刚好不小于目标尺寸的那一级重采样，
+    拖动缩放滑块的耗时因此与源图分辨率无关
+    """
     
-    # 计算居中位置
-    offset_x = (canvas_width - new_w) // 2
-    offset_y = (canvas_height - new_h) // 2
+    def __init__(self, image: Image.Image, canvas_width: int = 596, canvas_height: int = 832,
+                 min_scale_percent: float = MIN_SCALE_PERCENT):
+        if image.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+            image = image.convert('RGB')
+        self.info = dict(image.info)
+        self.size = image.size
+        self.levels = [image]
+        
+        min_w, min_h, _ = _fit_size(image.width, image.height, canvas_width, canvas_height,
+                                    min_scale_percent)
+        level = image
+        while level.width // 2 >= max(1, min_w) and level.height // 2 >= max(1, min_h):
+            level = level.reduce(2)
+            self.levels.append(level)
     
-    # 粘贴图像到画布
-    canvas.paste(scaled_img, (offset_x, offset_y))
+    def level_for(self, width: int, height: int) -> Image.Image:
+        """不小于 width×height 的最小一级"""
+        for level in reversed(self.levels):
+            if level.width >= width and level.height >= height:
+                return level
+        return self.levels[0]
+    
+    def scale_to_canvas(self, canvas_width: int, canvas_height: int, scale_percent: float) -> tuple:
+        """
+        同 scale_image_to_canvas
+        """
+        canvas, src_w, src_h, real_scale = self.canvas_image(canvas_width, canvas_height, scale_percent)
+        return np.asarray(canvas), src_w, src_h, real_scale
+    
+    def canvas_image(self, canvas_width: int, canvas_height: int, scale_percent: float) -> tuple:
+        """
+        同 scale_image_to_canvas_image；每次粘贴到新画布（金字塔可被多个线程共用，
+        不能交出共享的可变缓冲区；粘贴相比 LANCZOS 缩放开销很小）
+        """
+        img_w, img_h = self.size
+        src_w, src_h = self.info.get('source_size', (img_w, img_h))
+        new_w, new_h, real_scale = _fit_size(img_w, img_h, canvas_width, canvas_height, scale_percent)
+        
+        level = self.level_for(new_w, new_h)
+        scaled_img = level.resize((new_w, new_h), Image.Resampling.LANCZOS)
+        
+        canvas = Image.new('RGB', (canvas_width, canvas_height), 'white')
+        _paste_centered(canvas, scaled_img)
+        
+        return canvas, src_w, src_h, real_scale * img_w / src_w
+
+
+# 行带并行：每带的行数（取 64 的倍数，使有序抖动阈值平面在各带中的相位与整幅图一致）
+ROW_BAND_HEIGHT = 128
+
+
+@lru_cache(maxsize=4)
+def band_executor(threads: int) -> ThreadPoolExecutor:
+    """
+    按线程数共享的线程池（NumPy/Pillow 的大数组运算会释放 GIL）
+    """
+    return ThreadPoolExecutor(max_workers=threads, thread_name_prefix='cup-band')
+
+
+def map_row_bands(fn, arrays: tuple, halo: int = 0, executor=None,
+                  band_height: int = ROW_BAND_HEIGHT) -> np.ndarray:
+    """
+    将逐行局部的运算沿第 0 轴（行）切成若干带并行执行，结果按行拼接
+    fn(*带切片) 返回与切片行数相同的结果；halo 为每带上下多取的行数，
+    计算后裁掉，因此只要 fn 的感受野不超过 halo 行，结果与整幅计算完全一致
+    executor 为 None 或图像只有一带时直接整幅计算
+    """
+    height = arrays[0].shape[0]
+    if executor is None or height <= band_height:
+        return fn(*arrays)
+    
+    def run(y0):
+        y1 = min(height, y0 + band_height)
+        a, b = max(0, y0 - halo), min(height, y1 + halo)
+        out = fn(*(arr[a:b] for arr in arrays))
+        return out[y0 - a:y1 - a]
     
-    return np.array(canvas), img_w, img_h, real_scale
+    return np.concatenate(list(executor.map(run, range(0, height, band_height))))
 
 
-def to_grayscale(img_array: np.ndarray) -> np.ndarray:
+class Workspace:
     """
-    将RGB图像转换为灰度图像
+    可复用的临时缓冲区：每个名称保留一个数组，画布尺寸不变时再次渲染直接覆盖写入，不再重新分配
+    传给各处理函数后，其中间数组和返回值都放在这里（返回值在下次同类计算时被覆盖）；
+    同一时间只能供一条管线、一个线程使用
     """
-    if len(img_array.shape) == 3 and img_array.shape[2] >= 3:
-        r, g, b = img_array[:, :, 0], img_array[:, :, 1], img_array[:, :, 2]
-        gray = np.round(0.299 * r + 0.587 * g + 0.114 * b).astype(np.uint8)
+    
+    def __init__(self):
+        self._buffers = {}
+    
+    def get(self, name: str, shape: tuple, dtype) -> np.ndarray:
+        """取名为 name 的缓冲区（内容未初始化）；形状或类型变化时替换为新数组"""
+        shape = tuple(shape)
+        dtype = np.dtype(dtype)
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = self._buffers[name] = np.empty(shape, dtype)
+        return buf
+    
+    @property
+    def nbytes(self) -> int:
+        return sum(buf.nbytes for buf in self._buffers.values())
+    
+    def clear(self):
+        """释放全部缓冲区"""
+        self._buffers.clear()
+
+
+def _scratch(workspace: Workspace, name: str, shape: tuple, dtype) -> np.ndarray:
+    """有 workspace 时取其中的缓冲区，否则新分配"""
+    if workspace is None:
+        return np.empty(shape, dtype)
+    return workspace.get(name, shape, dtype)
+
+
+def to_grayscale(img_array: np.ndarray, lut: np.ndarray = None, workspace: Workspace = None) -> np.ndarray:
+    """
+    将RGB图像转换为灰度图像（整数运算，结果与 round(0.299R + 0.587G + 0.114B) 一致）
+    传入 lut 时在同一遍中直接查表输出调整后的灰度
+    也接受 (N, H, W, 3) 的画布堆叠，返回 (N, H, W)
+    """
+    if img_array.ndim >= 3 and img_array.shape[-1] >= 3:
+        r, g, b = img_array[..., 0], img_array[..., 1], img_array[..., 2]
+        n = _scratch(workspace, 'gray_sum', r.shape, np.uint32)
+        q = _scratch(workspace, 'gray_quot', r.shape, np.uint32)
+        np.multiply(r, np.uint32(299), out=n)
+        n += np.multiply(g, np.uint32(587), out=q)
+        n += np.multiply(b, np.uint32(114), out=q)
+        n += 500
+        np.divmod(n, 1000, out=(q, n))
+        
+        # 余数为 0 即恰好落在 .5 上的像素，按原浮点公式舍入（极少数）
+        ties = np.nonzero(np.equal(n, 0, out=_scratch(workspace, 'gray_ties', r.shape, bool)))
+        if ties[0].size:
+            q[ties] = np.round(0.299 * r[ties] + 0.587 * g[ties] + 0.114 * b[ties])
+        
+        gray = _scratch(workspace, 'gray', r.shape, np.uint8)
+        if lut is not None:
+            return lut.take(q, out=gray)
+        np.copyto(gray, q, casting='unsafe')
         return gray
-    return img_array.astype(np.uint8)
+    
+    gray = img_array.astype(np.uint8)
+    return lut.take(gray) if lut is not None else gray
 
 
-def apply_gamma_contrast(gray: np.ndarray, contrast: int, gamma: float) -> np.ndarray:
+@lru_cache(maxsize=64)
+def gamma_contrast_lut(contrast: int, gamma: float) -> np.ndarray:
     """
-    应用对比度和Gamma调整
+    对比度 + Gamma 调整的 256 项查找表（按原浮点公式逐项计算，返回只读数组）
     """
+    levels = np.arange(256, dtype=float)
+    
     # 对比度调整
     c = np.clip(contrast, -100, 100)
     f = (259 * (c + 255)) / (255 * (259 - c))
-    adjusted = f * (gray.astype(float) - 128) + 128
+    adjusted = f * (levels - 128) + 128
     adjusted = np.clip(adjusted, 0, 255)
     
     # Gamma调整
     g = np.clip(gamma, 0.2, 3.0)
     normalized = adjusted / 255.0
     gamma_corrected = np.power(normalized, g)
-    result = np.round(gamma_corrected * 255).astype(np.uint8)
+    lut = np.round(gamma_corrected * 255).astype(np.uint8)
     
-    return result
+    lut.setflags(write=False)
+    return lut
 
 
-def dither_bayer(gray: np.ndarray) -> np.ndarray:
+def apply_gamma_contrast(gray: np.ndarray, contrast: int, gamma: float,
+                         workspace: Workspace = None) -> np.ndarray:
     """
-    Bayer矩阵抖动算法
+    应用对比度和Gamma调整（查表）
     """
-    h, w = gray.shape
-    binary = np.zeros((h, w), dtype=np.uint8)
-    
-    for y in range(h):
-        for x in range(w):
-            g = gray[y, x]
-            threshold = (BAYER8[y % 8, x % 8] + 0.5) * 4  # 0..255
-            binary[y, x] = 255 if g >= threshold else 0
+    out = _scratch(workspace, 'adjust', gray.shape, np.uint8)
+    return gamma_contrast_lut(contrast, gamma).take(gray, out=out)
+
+
+def to_adjusted_grayscale(img_array: np.ndarray, contrast: int, gamma: float) -> np.ndarray:
+    """
+    RGB 画布 -> 调整后的 8 位灰度，一遍整数运算加查表完成
+    """
+    return to_grayscale(img_array, gamma_contrast_lut(contrast, gamma))
+
+
+def dither_bayer(gray: np.ndarray, size: int = 8) -> np.ndarray:
+    """
+    Bayer矩阵抖动算法（size 可选 4/8/16/32）
+    """
+    return _kernel('bayer')(gray, size)
+
+
+@register_kernel('bayer', 'numpy')
+def _dither_bayer_numpy(gray: np.ndarray, size: int = 8) -> np.ndarray:
+    """
+    整幅图与平铺好的阈值平面一次比较完成
+    """
+    h, w = gray.shape[-2:]
+    plane = bayer_threshold_plane(size, h, w)
+    return (gray >= plane).astype(np.uint8) * np.uint8(255)
+
+
+def dither_blue_noise(gray: np.ndarray, size: int = BLUE_NOISE_SIZE) -> np.ndarray:
+    """
+    蓝噪声有序抖动：与平铺的蓝噪声阈值平面一次比较完成
+    """
+    h, w = gray.shape[-2:]
+    plane = blue_noise_threshold_plane(size, h, w)
+    return (gray >= plane).astype(np.uint8) * np.uint8(255)
+
+
+def _diffusion_plan(kernel: str) -> tuple:
+    """
+    拆分扩散核：返回 (向前两项 (a, n1, b, n2), 向下各项, 分母, 行深度, 左右边距)
+    """
+    terms, divisor = DIFFUSION_KERNELS[kernel]
+    forward = [(dx, num) for dx, dy, num in terms if dy == 0]
+    (f1, n1), (f2, n2) = (forward + [(0, 0)])[:2]
+    # 按源像素的处理顺序（dx 从大到小）累加，与逐像素扩散的求和顺序一致
+    below = sorted([(dx, dy, num) for dx, dy, num in terms if dy > 0], key=lambda t: -t[0])
+    depth = max(dy for _, dy, _ in terms) + 1
+    pad = max(abs(dx) for dx, _, _ in terms)
+    return (f1, n1, f2, n2), below, divisor, depth, pad
+
+
+def _diffuse_span(vals: list, xs: range, a: int, n1: int, b: int, n2: int, divisor: int):
+    """
+    行内误差传递（唯一无法向量化的部分）：按 xs 顺序阈值化 vals，
+    并把误差传给同一行前方 a、b 处的像素
+    """
+    if n2:
+        for x in xs:
+            v = vals[x]
+            if v >= 128:
+                v -= 255
+            vals[x + a] += v * n1 / divisor
+            vals[x + b] += v * n2 / divisor
+    else:
+        for x in xs:
+            v = vals[x]
+            if v >= 128:
+                v -= 255
+            vals[x + a] += v * n1 / divisor
+
+
+def dither_error_diffusion(gray: np.ndarray, kernel: str = 'floyd-steinberg',
+                           serpentine: bool = True) -> np.ndarray:
+    """
+    误差扩散算法（kernel 见 DIFFUSION_KERNELS）
+    """
+    return _kernel('error_diffusion')(gray, kernel, serpentine)
+
+
+@register_kernel('error_diffusion', 'numpy')
+def _dither_error_diffusion_numpy(gray: np.ndarray, kernel: str = 'floyd-steinberg',
+                                  serpentine: bool = True) -> np.ndarray:
+    """
+    查表驱动的误差扩散算法（整幅一次送入 ErrorDiffusionStream）
+    误差按扫描顺序逐行传递，有前导轴（多张图）时逐张处理
+    """
+    if gray.ndim > 2:
+        return _per_image(_dither_error_diffusion_numpy)(gray, kernel, serpentine)
     
+    h, w = gray.shape
+    _, binary = ErrorDiffusionStream(w, h, kernel, serpentine).feed(gray)
     return binary
 
 
-def dither_floyd_steinberg(gray: np.ndarray, serpentine: bool = True) -> np.ndarray:
+class ErrorDiffusionStream:
     """
-    Floyd-Steinberg误差扩散算法
+    可分带送入的误差扩散
+    逐行处理：行内只做阈值和向前的误差传递，向下的误差整行一次性累加到
+    预分配的进位缓冲区（左右留出边距，无需逐像素判断边界）
+    进位缓冲区在两次 feed 之间保留，按任意行带依次送入的结果与整幅处理逐位一致；
+    每行处理前要先载入其下方 depth-1 行，因此输出比输入最多落后 depth-1 行
     """
-    h, w = gray.shape
-    g = gray.astype(np.float32)
-    binary = np.zeros((h, w), dtype=np.uint8)
     
-    for y in range(h):
-        if serpentine:
-            left_to_right = (y % 2) == 0
-        else:
-            left_to_right = True
+    def __init__(self, width: int, height: int, kernel: str = 'floyd-steinberg', serpentine: bool = True):
+        self.width = width
+        self.height = height
+        self.serpentine = serpentine
+        self._plan = _diffusion_plan(kernel)
+        _, _, _, depth, pad = self._plan
+        # 进位缓冲区：环形存放当前行及其下方 depth-1 行
+        self._carry = np.zeros((depth, width + 2 * pad), dtype=np.float64)
+        self.loaded = 0  # 已载入的行数
+        self.done = 0    # 已输出的行数
+    
+    def feed(self, rows: np.ndarray) -> tuple:
+        """
+        送入接下来的若干行灰度，返回 (起始行号, 新完成的二值行)；送完最后一行时全部输出
+        """
+        w = self.width
+        _, _, _, depth, pad = self._plan
+        start = self.done
+        binary = np.empty((self.loaded + len(rows) - start, w), dtype=np.uint8)
+        
+        for row in rows:
+            # 载入前先处理完占用同一缓冲槽的行
+            while self.done <= self.loaded - depth:
+                self._run_row(binary[self.done - start])
+            slot = self._carry[self.loaded % depth]
+            slot[:] = 0
+            slot[pad:pad + w] = row
+            self.loaded += 1
+        
+        while self.done < self.loaded and self.loaded >= min(self.height, self.done + depth):
+            self._run_row(binary[self.done - start])
+        
+        return start, binary[:self.done - start]
+    
+    def _run_row(self, out: np.ndarray):
+        (f1, n1, f2, n2), below, divisor, depth, pad = self._plan
+        w, h, y = self.width, self.height, self.done
+        carry = self._carry
+        
+        left_to_right = (y % 2) == 0 if self.serpentine else True
+        step = 1 if left_to_right else -1
         
+        vals = carry[y % depth].tolist()
         if left_to_right:
-            x_range = range(w)
+            xs = range(pad, pad + w)
         else:
-            x_range = range(w - 1, -1, -1)
+            xs = range(pad + w - 1, pad - 1, -1)
+        _diffuse_span(vals, xs, f1 * step, n1, f2 * step, n2, divisor)
+        
+        row = np.array(vals[pad:pad + w])
+        white = row >= 128
+        out[:] = white
+        out *= 255
+        err = row - 255 * white
+        
+        # 向下的误差整行累加
+        for dx, dy, num in below:
+            if y + dy >= h:
+                continue
+            start = pad + dx * step
+            carry[(y + dy) % depth, start:start + w] += err * num / divisor
         
-        for x in x_range:
-            old_val = g[y, x]
-            new_val = 0 if old_val < 128 else 255
-            binary[y, x] = new_val
-            err = old_val - new_val
-            
-            # 分散误差到周围像素
-            if left_to_right:
-                if x + 1 < w:
-                    g[y, x + 1] += err * 7 / 16
-                if y + 1 < h:
-                    if x - 1 >= 0:
-                        g[y + 1, x - 1] += err * 3 / 16
-                    g[y + 1, x] += err * 5 / 16
-                    if x + 1 < w:
-                        g[y + 1, x + 1] += err * 1 / 16
-            else:
-                if x - 1 >= 0:
-                    g[y, x - 1] += err * 7 / 16
-                if y + 1 < h:
-                    if x + 1 < w:
-                        g[y + 1, x + 1] += err * 3 / 16
-                    g[y + 1, x] += err * 5 / 16
-                    if x - 1 >= 0:
-                        g[y + 1, x - 1] += err * 1 / 16
+        self.done += 1
+
+
+def dither_floyd_steinberg(gray: np.ndarray, serpentine: bool = True) -> np.ndarray:
+    """
+    Floyd-Steinberg误差扩散算法
+    """
+    return dither_error_diffusion(gray, 'floyd-steinberg', serpentine)
+
+
+class PackedSticker:
+    """
+    1 位打包的二值杯贴：每行用 np.packbits 打包，位为 1 表示白色
+    596×832 只占约 62 KB（uint8 0/255 数组约 496 KB），可无损转换为 PIL '1' 模式图像
+    """
     
-    return binary
+    __slots__ = ('bits', 'width')
+    
+    def __init__(self, bits: np.ndarray, width: int):
+        self.bits = bits
+        self.width = width
+    
+    @classmethod
+    def from_array(cls, binary: np.ndarray) -> 'PackedSticker':
+        """从 0/255 二值数组打包"""
+        return cls(np.packbits(binary >= 128, axis=-1), binary.shape[-1])
+    
+    @classmethod
+    def from_image(cls, image: Image.Image) -> 'PackedSticker':
+        """从 '1' 模式图像读取（其他模式按 >= 128 为白二值化）"""
+        if image.mode != '1':
+            return cls.from_array(np.asarray(image.convert('L')))
+        w, h = image.size
+        # tobytes 已是独立的副本，直接作为只读位数组使用
+        bits = np.frombuffer(image.tobytes(), dtype=np.uint8).reshape(h, -(-w // 8))
+        return cls(bits, w)
+    
+    @property
+    def height(self) -> int:
+        return self.bits.shape[-2]
+    
+    @property
+    def shape(self) -> tuple:
+        return self.bits.shape[:-1] + (self.width,)
+    
+    @property
+    def nbytes(self) -> int:
+        return self.bits.nbytes
+    
+    def to_array(self) -> np.ndarray:
+        """解包为 0/255 的 uint8 数组"""
+        white = np.unpackbits(self.bits, axis=-1, count=self.width)
+        white *= 255
+        return white
+    
+    def to_image(self) -> Image.Image:
+        """转换为 PIL '1' 模式图像（行字节布局与 packbits 相同，直接从位数组的缓冲区读取）"""
+        bits = np.ascontiguousarray(self.bits)
+        return Image.frombuffer('1', (self.width, self.height), bits, 'raw', '1', 0, 1)
+    
+    def save(self, fp, format: str = 'PNG'):
+        """保存为 1 位图像文件"""
+        self.to_image().save(fp, format)
+    
+    def blacken(self, mask: np.ndarray) -> 'PackedSticker':
+        """mask 为真的像素置黑，返回新的 PackedSticker"""
+        return PackedSticker(self.bits & ~np.packbits(mask, axis=-1), self.width)
+    
+    def __eq__(self, other):
+        if not isinstance(other, PackedSticker):
+            return NotImplemented
+        return self.width == other.width and np.array_equal(self.bits, other.bits)
 
 
-def sobel_magnitude(gray: np.ndarray) -> np.ndarray:
+def sobel_magnitude(gray: np.ndarray, workspace: Workspace = None) -> np.ndarray:
     """
-    Sobel边缘检测：计算梯度幅值
+    Sobel边缘检测：计算梯度幅值 |gx| + |gy|（截断到 0..255，边框为 0）
     """
-    h, w = gray.shape
-    mag = np.zeros((h, w), dtype=np.uint8)
-    
-    for y in range(1, h - 1):
-        for x in range(1, w - 1):
-            # Sobel算子
-            gx = (-gray[y-1, x-1] + gray[y-1, x+1] - 
-                  2*gray[y, x-1] + 2*gray[y, x+1] -
-                  gray[y+1, x-1] + gray[y+1, x+1])
-            gy = (-gray[y-1, x-1] - 2*gray[y-1, x] - gray[y-1, x+1] +
-                  gray[y+1, x-1] + 2*gray[y+1, x] + gray[y+1, x+1])
-            
-            mag[y, x] = np.clip(np.abs(gx) + np.abs(gy), 0, 255)
+    return _kernel('sobel')(gray, workspace)
+
+
+@register_kernel('sobel', 'numpy')
+def _sobel_magnitude_numpy(gray: np.ndarray, workspace: Workspace = None) -> np.ndarray:
+    """
+    可分离核整幅切片计算，中间结果用 int16，避免 uint8 回绕
+    """
+    h, w = gray.shape[-2:]
+    lead = gray.shape[:-2]
+    mag = _scratch(workspace, 'sobel', gray.shape, np.uint8)
+    if h < 3 or w < 3:
+        mag[...] = 0
+        return mag
+    
+    g = _scratch(workspace, 'sobel_g', gray.shape, np.int16)
+    np.copyto(g, gray)
+    d = _scratch(workspace, 'sobel_d', lead + (h, w - 2), np.int16)
+    gx = _scratch(workspace, 'sobel_gx', lead + (h - 2, w - 2), np.int16)
+    gy = _scratch(workspace, 'sobel_gy', lead + (h - 2, w - 2), np.int16)
     
+    # gx = [1 2 1]ᵀ ⊗ [-1 0 1]
+    dx = np.subtract(g[..., :, 2:], g[..., :, :-2], out=d)
+    np.add(dx[..., :-2, :], dx[..., 2:, :], out=gx)
+    gx += dx[..., 1:-1, :]
+    gx += dx[..., 1:-1, :]
+    # gy = [-1 0 1]ᵀ ⊗ [1 2 1]
+    sx = np.add(g[..., :, :-2], g[..., :, 2:], out=d)
+    sx += g[..., :, 1:-1]
+    sx += g[..., :, 1:-1]
+    np.subtract(sx[..., 2:, :], sx[..., :-2, :], out=gy)
+    
+    np.abs(gx, out=gx)
+    np.abs(gy, out=gy)
+    gx += gy
+    np.minimum(gx, 255, out=gx)
+    mag[..., 1:-1, 1:-1] = gx
+    mag[..., (0, -1), :] = 0
+    mag[..., :, (0, -1)] = 0
     return mag
 
 
-def dilate_mask(mask: np.ndarray, iterations: int = 1) -> np.ndarray:
+def _dilate_axis(mask: np.ndarray, radius: int, axis: int) -> np.ndarray:
     """
-    形态学膨胀操作
-    """
-    h, w = mask.shape
-    result = mask.copy()
-    
-    for _ in range(iterations):
-        new_result = result.copy()
-        for y in range(h):
-            for x in range(w):
-                if result[y, x] > 0:
-                    new_result[y, x] = 1
-                    continue
-                
-                # 检查8邻域
-                found = False
-                for dy in [-1, 0, 1]:
-                    for dx in [-1, 0, 1]:
-                        ny, nx = y + dy, x + dx
-                        if 0 <= ny < h and 0 <= nx < w:
-                            if result[ny, nx] > 0:
-                                found = True
-                                break
-                    if found:
-                        break
-                
-                new_result[y, x] = 1 if found else 0
-        
-        result = new_result
+    沿一个轴做半径 radius 的一维膨胀（布尔数组）
+    每轮把已覆盖的窗口左右平移后取并，窗口约按 3 倍增长，只需 O(log r) 次数组运算
+    """
+    n = mask.shape[axis]
+    if radius >= n - 1:
+        # 窗口已覆盖整条轴
+        return np.broadcast_to(mask.any(axis=axis, keepdims=True), mask.shape).copy()
+    
+    # 两端补 radius 个 False，使平移到边界外的窗口仍然有效
+    widths = [(0, 0)] * mask.ndim
+    widths[axis] = (radius, radius)
+    out = np.pad(mask, widths)
     
+    reach = 0  # out[x] 已覆盖 [x-reach, x+reach]
+    while reach < radius:
+        s = min(2 * reach + 1, radius - reach)
+        head = [slice(None)] * out.ndim
+        tail = [slice(None)] * out.ndim
+        head[axis] = slice(s, None)
+        tail[axis] = slice(None, -s)
+        head, tail = tuple(head), tuple(tail)
+        grown = out.copy()
+        grown[head] |= out[tail]
+        grown[tail] |= out[head]
+        out = grown
+        reach += s
+    
+    crop = [slice(None)] * out.ndim
+    crop[axis] = slice(radius, radius + n)
+    return out[tuple(crop)]
+
+
+def dilate_mask(mask: np.ndarray, iterations: int = 1) -> np.ndarray:
+    """
+    形态学膨胀操作（8邻域），返回 0/1 的 uint8 数组
+    """
+    return _kernel('dilate')(mask, iterations)
+
+
+@register_kernel('dilate', 'numpy')
+def _dilate_mask_numpy(mask: np.ndarray, iterations: int = 1) -> np.ndarray:
+    """
+    迭代 k 次等价于一次 (2k+1)×(2k+1) 方形结构元，按行、列两次一维膨胀完成
+    """
+    result = mask > 0
+    if iterations > 0:
+        result = _dilate_axis(result, iterations, -1)
+        result = _dilate_axis(result, iterations, -2)
     return result.astype(np.uint8)
 
 
+def build_edge_mask(gray: np.ndarray, lo_threshold: int, hi_threshold: int,
+                    tau_threshold: int, edge: np.ndarray = None,
+                    workspace: Workspace = None) -> tuple:
+    """
+    计算应被加黑的区域：灰度 <= lo，或 边缘强度 >= tau 且灰度 < hi
+    返回 (布尔掩码, 边缘图)；传入 edge 时直接复用
+    """
+    if edge is None:
+        edge = sobel_magnitude(gray, workspace)
+    black_mask = np.less_equal(gray, lo_threshold, out=_scratch(workspace, 'edge_mask', gray.shape, bool))
+    strong = np.greater_equal(edge, tau_threshold, out=_scratch(workspace, 'edge_strong', gray.shape, bool))
+    strong &= np.less(gray, hi_threshold, out=_scratch(workspace, 'edge_dark', gray.shape, bool))
+    black_mask |= strong
+    return black_mask, edge
+
+
 def apply_edge_protection(binary: np.ndarray, gray: np.ndarray, 
                          lo_threshold: int, hi_threshold: int, 
-                         tau_threshold: int, dilate_iters: int = 1) -> np.ndarray:
+                         tau_threshold: int, dilate_iters: int = 1,
+                         edge: np.ndarray = None, executor=None,
+                         workspace: Workspace = None) -> np.ndarray:
     """
     边缘保护：仅加黑不漂白
+    binary 可以是 0/255 数组或 PackedSticker，返回同类型
+    传入 executor 时掩码按行带并行计算（各带自行分配，不使用 workspace）
     """
-    h, w = gray.shape
-    edge = sobel_magnitude(gray)
-    black_mask = np.zeros((h, w), dtype=np.uint8)
-    
-    # 检测应该被加黑的区域
-    for y in range(h):
-        for x in range(w):
-            if gray[y, x] <= lo_threshold or (edge[y, x] >= tau_threshold and gray[y, x] < hi_threshold):
-                black_mask[y, x] = 1
+    band_workspace = workspace if executor is None else None
     
-    # 膨胀黑色掩码
-    if dilate_iters > 0:
-        black_mask = dilate_mask(black_mask, dilate_iters)
+    def band_mask(g, e=None):
+        # 检测应该被加黑的区域
+        black_mask, _ = build_edge_mask(g, lo_threshold, hi_threshold, tau_threshold, e, band_workspace)
+        
+        # 膨胀黑色掩码
+        if dilate_iters > 0:
+            black_mask = dilate_mask(black_mask.view(np.uint8), dilate_iters) > 0
+        return black_mask
     
-    # 只加黑，不改白
-    result = binary.copy()
-    result[black_mask > 0] = 0
+    # 按行带并行时，带间重叠的行数覆盖膨胀半径（现算 Sobel 时再加 1 行）
+    if edge is None:
+        black_mask = map_row_bands(band_mask, (gray,), dilate_iters + 1, executor)
+    else:
+        black_mask = map_row_bands(band_mask, (gray, edge), dilate_iters, executor)
     
-    return result
+    # 只加黑，不改白（打包格式按位与完成）
+    if isinstance(binary, PackedSticker):
+        return binary.blacken(black_mask)
+    return np.where(black_mask, np.uint8(0), binary)
 
 
-def circle_halftone(gray: np.ndarray, canvas_width: int, canvas_height: int,
-                   cell: int, angle_deg: float, shape: str) -> np.ndarray:
+# 半调晶格（只取决于画布尺寸、单元大小和角度）
+HalftoneLattice = namedtuple('HalftoneLattice', [
+    'cell',         # 实际单元大小 s
+    'center_x',     # (n_j, n_i) 单元中心
+    'center_y',
+    'outside',      # (n_j, n_i) 中心在画布外、不绘制的单元
+    'samples',      # (9, n_j, n_i) 3×3 取样点在灰度图中的平坦下标，按原累加顺序
+    'origin',       # 像素 -> 晶格坐标变换的参数 (cx, cy, cos, sin, i_min, j_min)
+])
+
+# 半调晶格几何，另含整幅画布每个像素所属的单元
+HalftoneGeometry = namedtuple('HalftoneGeometry', [
+    'cell',
+    'center_x',
+    'center_y',
+    'outside',
+    'samples',
+    'cell_index',   # (h, w) 每个像素所在单元的平坦下标
+    'dist_sq',      # (h, w) 每个像素到所在单元中心的距离平方（圆点用）
+])
+
+
+@lru_cache(maxsize=4)
+def halftone_lattice(width: int, height: int, cell: int, angle_deg: float) -> HalftoneLattice:
     """
-    圆形半调点网格算法（支持圆形、方形、十字）
+    计算并缓存旋转晶格：单元中心与取样下标（数组大小与单元数成正比，均为只读）
     """
-    h, w = gray.shape  # 从灰度图获取实际尺寸
-    binary = np.ones((h, w), dtype=np.uint8) * 255  # 白色背景
-    
+    w, h = width, height
     s = max(2, min(60, cell))
     theta = np.deg2rad(angle_deg)
     c, si = np.cos(theta), np.sin(theta)
     cx, cy = w / 2, h / 2
     
-    # 坐标变换函数
+    # 坐标变换函数（标量与数组通用）
     def to_xy(i, j):
         x = cx + s * (i * c - j * si)
         y = cy + s * (i * si + j * c)
@@ -265,205 +992,1035 @@ def circle_halftone(gray: np.ndarray, canvas_width: int, canvas_height: int,
     j_min = int(np.floor(min(j_vals))) - 1
     j_max = int(np.ceil(max(j_vals))) + 1
     
-    # 采样偏移
+    # 单元中心
+    I = np.arange(i_min, i_max + 1, dtype=np.float64)[None, :]
+    J = np.arange(j_min, j_max + 1, dtype=np.float64)[:, None]
+    center_x, center_y = to_xy(I + 0.5, J + 0.5)
+    outside = (center_x < -s) | (center_x > w + s) | (center_y < -s) | (center_y > h + s)
+    n_j, n_i = center_x.shape
+    
+    # 取样周围像素（3×3）
     offsets = [-0.35, 0, 0.35]
-    side_max = s * 0.98
+    samples = np.empty((9, n_j, n_i), dtype=np.intp)
+    k = 0
+    for dv in offsets:
+        for du in offsets:
+            sx, sy = to_xy(I + 0.5 + du, J + 0.5 + dv)
+            ix = np.clip(np.round(sx), 0, w - 1).astype(np.intp)
+            iy = np.clip(np.round(sy), 0, h - 1).astype(np.intp)
+            samples[k] = iy * w + ix
+            k += 1
     
-    for J in range(j_min, j_max + 1):
-        for I in range(i_min, i_max + 1):
-            # 晶格中心
-            center_x, center_y = to_xy(I + 0.5, J + 0.5)
-            
-            if center_x < -s or center_x > w + s or center_y < -s or center_y > h + s:
-                continue
-            
-            # 取样周围像素
-            sample_sum = 0.0
-            count = 0
-            for dv in offsets:
-                for du in offsets:
-                    sx, sy = to_xy(I + 0.5 + du, J + 0.5 + dv)
-                    ix = int(np.clip(np.round(sx), 0, w - 1))
-                    iy = int(np.clip(np.round(sy), 0, h - 1))
-                    sample_sum += float(gray[iy, ix])
-                    count += 1
-            
-            avg = sample_sum / count if count > 0 else 0
-            darkness = 1 - (avg / 255.0)
-            radius = np.sqrt(max(0, darkness)) * (side_max / 2)
-            
-            if radius > 0.25:
-                # 绘制形状
-                if shape == 'square':
-                    # 方形
-                    half_side = min(side_max / 2, radius)
-                    x_min = int(np.round(center_x - half_side))
-                    x_max = int(np.round(center_x + half_side))
-                    y_min = int(np.round(center_y - half_side))
-                    y_max = int(np.round(center_y + half_side))
-                    
-                    for y in range(max(0, y_min), min(h, y_max)):
-                        for x in range(max(0, x_min), min(w, x_max)):
-                            binary[y, x] = 0
-                
-                elif shape == 'cross':
-                    # 十字
-                    length = side_max
-                    thick = max(1, radius * 0.9)
-                    
-                    # 水平线
-                    y_range = range(max(0, int(center_y - thick/2)), 
-                                   min(h, int(center_y + thick/2)))
-                    x_range = range(max(0, int(center_x - length/2)), 
-                                   min(w, int(center_x + length/2)))
-                    for y in y_range:
-                        for x in x_range:
-                            binary[y, x] = 0
-                    
-                    # 竖线
-                    y_range = range(max(0, int(center_y - length/2)), 
-                                   min(h, int(center_y + length/2)))
-                    x_range = range(max(0, int(center_x - thick/2)), 
-                                   min(w, int(center_x + thick/2)))
-                    for y in y_range:
-                        for x in x_range:
-                            binary[y, x] = 0
-                
-                else:  # circle
-                    # 圆形
-                    radius_sq = radius ** 2
-                    y_min = max(0, int(center_y - radius))
-                    y_max = min(h, int(center_y + radius) + 1)
-                    x_min = max(0, int(center_x - radius))
-                    x_max = min(w, int(center_x + radius) + 1)
-                    
-                    for y in range(y_min, y_max):
-                        for x in range(x_min, x_max):
-                            dx = x - center_x
-                            dy = y - center_y
-                            if dx*dx + dy*dy <= radius_sq:
-                                binary[y, x] = 0
+    lattice = HalftoneLattice(s, center_x, center_y, outside, samples, (cx, cy, c, si, i_min, j_min))
+    for arr in lattice[1:5]:
+        arr.setflags(write=False)
+    return lattice
+
+
+def halftone_pixel_cells(lattice: HalftoneLattice, width: int, y0: int, y1: int) -> tuple:
+    """
+    第 y0..y1-1 行每个像素所在单元的平坦下标和到单元中心的距离平方
+    （像素所在单元的 ±1 邻居一定仍在晶格范围内）
+    """
+    cx, cy, c, si, i_min, j_min = lattice.origin
+    s = lattice.cell
+    n_i = lattice.center_x.shape[1]
+    
+    px = np.arange(width, dtype=np.float64)[None, :]
+    py = np.arange(y0, y1, dtype=np.float64)[:, None]
+    dx, dy = px - cx, py - cy
+    pi = (dx * c + dy * si) / s
+    pj = (-dx * si + dy * c) / s
+    cell_index = (np.floor(pj).astype(np.intp) - j_min) * n_i + (np.floor(pi).astype(np.intp) - i_min)
     
+    dx = px - lattice.center_x.take(cell_index)
+    dy = py - lattice.center_y.take(cell_index)
+    dist_sq = dx * dx + dy * dy
+    return cell_index, dist_sq
+
+
+@lru_cache(maxsize=4)
+def halftone_geometry(width: int, height: int, cell: int, angle_deg: float) -> HalftoneGeometry:
+    """
+    计算并缓存整幅画布的半调几何：晶格加上每个像素所属的单元
+    只改 Gamma/对比度等参数时重复渲染可直接复用；数组均为只读
+    """
+    lattice = halftone_lattice(width, height, cell, angle_deg)
+    cell_index, dist_sq = halftone_pixel_cells(lattice, width, 0, height)
+    cell_index.setflags(write=False)
+    dist_sq.setflags(write=False)
+    return HalftoneGeometry(*lattice[:5], cell_index, dist_sq)
+
+
+def _halftone_rows(cell_index: np.ndarray, dist_sq: np.ndarray, py: np.ndarray,
+                   n_i: int, cells, workspace: Workspace = None) -> np.ndarray:
+    """
+    半调的逐像素部分：对若干行判断每个像素是否落在点内
+    cells 为圆点时是每个单元的半径平方，方形/十字时是边界列表；
+    cells 带前导轴（多张图）时结果形状为 前导轴 + cell_index.shape
+    """
+    lead = (cells if not isinstance(cells, list) else cells[0][0]).shape[:-2]
+    flat = lambda a: np.broadcast_to(a, lead + a.shape[-2:]).reshape(lead + (-1,))
+    shape = lead + cell_index.shape
+    bound = _scratch(workspace, 'halftone_bound', shape, np.float64)
+    black = _scratch(workspace, 'halftone_black', shape, bool)
+    
+    if not isinstance(cells, list):  # circle
+        # 圆点严格位于本单元的内切圆中，只需与本单元比较
+        np.less_equal(dist_sq, flat(cells).take(cell_index, axis=-1, out=bound), out=black)
+    else:
+        # 方形和十字可能伸进相邻单元，需检查 3×3 邻居
+        px = np.arange(shape[-1], dtype=np.float64)[None, :]
+        idx = _scratch(workspace, 'halftone_idx', cell_index.shape, np.intp)
+        inside = _scratch(workspace, 'halftone_inside', shape, bool)
+        test = _scratch(workspace, 'halftone_test', shape, bool)
+        black[...] = False
+        cells = [tuple(flat(b) for b in bounds) for bounds in cells]
+        for dj in (-1, 0, 1):
+            for di in (-1, 0, 1):
+                np.add(cell_index, dj * n_i + di, out=idx)
+                for bx0, bx1, by0, by1 in cells:
+                    np.greater_equal(px, bx0.take(idx, axis=-1, out=bound), out=inside)
+                    inside &= np.less(px, bx1.take(idx, axis=-1, out=bound), out=test)
+                    inside &= np.greater_equal(py, by0.take(idx, axis=-1, out=bound), out=test)
+                    inside &= np.less(py, by1.take(idx, axis=-1, out=bound), out=test)
+                    black |= inside
+    
+    binary = _scratch(workspace, 'halftone', shape, np.uint8)
+    binary[...] = 255  # 白色背景
+    binary[black] = 0
     return binary
 
 
+def circle_halftone(gray: np.ndarray, canvas_width: int, canvas_height: int,
+                   cell: int, angle_deg: float, shape: str, executor=None,
+                   workspace: Workspace = None) -> np.ndarray:
+    """
+    圆形半调点网格算法（支持圆形、方形、十字）
+    """
+    return _kernel('halftone')(gray, canvas_width, canvas_height, cell, angle_deg, shape, executor, workspace)
+
+
+@register_kernel('halftone', 'numpy')
+def _circle_halftone_numpy(gray: np.ndarray, canvas_width: int, canvas_height: int,
+                           cell: int, angle_deg: float, shape: str, executor=None,
+                           workspace: Workspace = None) -> np.ndarray:
+    """
+    先对所有晶格单元一次性采样求出点半径，再对每个像素用一次距离/边界比较决定是否落在点内
+    传入 executor 时逐像素部分按行带并行（各带自行分配，不使用 workspace）
+    gray 有前导轴（同一屏幕参数的多张图）时共用晶格几何，一起计算
+    """
+    h, w = gray.shape[-2:]  # 从灰度图获取实际尺寸
+    geo = halftone_geometry(w, h, cell, angle_deg)
+    cells = _halftone_cells(gray, geo, shape)
+    n_i = geo.center_x.shape[1]
+    
+    # ===== 逐像素 =====
+    py = np.arange(h, dtype=np.float64)[:, None]
+    if gray.ndim > 2:
+        # 行带按第 0 轴拼接，多张图时不分带（批量处理按图像分块并行，见 process_images）
+        executor = None
+    band_workspace = workspace if executor is None else None
+    return map_row_bands(lambda ci, ds, y: _halftone_rows(ci, ds, y, n_i, cells, band_workspace),
+                         (geo.cell_index, geo.dist_sq, py), executor=executor)
+
+
+def _halftone_cells(gray: np.ndarray, lattice: HalftoneLattice, shape: str):
+    """
+    半调的逐晶格单元部分：采样求点半径，并把点形状化成 _halftone_rows 所需的形式
+    """
+    s = lattice.cell
+    center_x, center_y = lattice.center_x, lattice.center_y
+    
+    side_max = s * 0.98
+    flat = gray.reshape(gray.shape[:-2] + (-1,))
+    sample_sum = np.zeros(gray.shape[:-2] + center_x.shape, dtype=np.float64)
+    for idx in lattice.samples:
+        sample_sum += flat.take(idx, axis=-1)
+    
+    avg = sample_sum / 9
+    darkness = 1 - (avg / 255.0)
+    radius = np.sqrt(np.maximum(0, darkness)) * (side_max / 2)
+    
+    # 画布外的单元与过小的点不绘制
+    draw = (radius > 0.25) & ~lattice.outside
+    
+    if shape not in ('square', 'cross'):  # circle
+        return np.where(draw, radius ** 2, -1.0)
+    
+    # 每个单元的点形状预先化成边界，不绘制的单元给一个空区间
+    if shape == 'square':
+        # 方形
+        half_side = np.minimum(side_max / 2, radius)
+        x0, x1 = np.round(center_x - half_side), np.round(center_x + half_side)
+        y0, y1 = np.round(center_y - half_side), np.round(center_y + half_side)
+        x0 = np.where(draw, x0, np.inf)
+        return [(x0, x1, y0, y1)]
+    
+    # 十字（与原实现一样用 int() 截断边界）
+    length = side_max
+    thick = np.maximum(1, radius * 0.9)
+    hx0, hx1 = np.trunc(center_x - length / 2), np.trunc(center_x + length / 2)
+    hy0, hy1 = np.trunc(center_y - thick / 2), np.trunc(center_y + thick / 2)
+    vx0, vx1 = np.trunc(center_x - thick / 2), np.trunc(center_x + thick / 2)
+    vy0, vy1 = np.trunc(center_y - length / 2), np.trunc(center_y + length / 2)
+    hx0 = np.where(draw, hx0, np.inf)  # 多张图时广播出前导轴
+    vx0 = np.where(draw, vx0, np.inf)
+    return [(hx0, hx1, hy0, hy1), (vx0, vx1, vy0, vy1)]
+
+
+def binarize(gray: np.ndarray, mode: str, canvas_width: int, canvas_height: int,
+             grid_size: int, shape: str, angle: float, fs_serpentine: bool = True,
+             executor=None, workspace: Workspace = None) -> np.ndarray:
+    """
+    按模式把调整后的灰度图二值化，返回 0/255 数组
+    mode 不是有序抖动、蓝噪声或误差扩散时按 shape 做旋转晶格半调
+    """
+    if mode in BAYER_MODES:
+        return map_row_bands(lambda g: dither_bayer(g, BAYER_MODES[mode]), (gray,), executor=executor)
+    if mode == 'bluenoise':
+        return map_row_bands(dither_blue_noise, (gray,), executor=executor)
+    if mode in DIFFUSION_MODES:
+        return dither_error_diffusion(gray, DIFFUSION_MODES[mode], fs_serpentine)
+    return circle_halftone(gray, canvas_width, canvas_height, grid_size, angle, shape, executor, workspace)
+
+
+class RenderPipeline:
+    """
+    带阶段缓存的处理管线
+    每个阶段按其依赖的参数（连同上游阶段的键）缓存输出，参数变化时只重算下游阶段；
+    GUI 为每张图片保留一个实例，拖动滑块时大多数渲染都能从缓存的灰度图开始
+    二值结果以 PackedSticker 缓存，占用内存为 uint8 数组的 1/8
+    灰度、调整后灰度、边缘图等中间数组写在 workspace 的缓冲区中：每个阶段只缓存一份结果，
+    重算时旧结果本来就要丢弃，因此可以原地覆盖
+    """
+    
+    STAGES = ('scale', 'gray', 'adjust', 'binary', 'sobel', 'edge')
+    # 缓存阶段 -> 计时报告的阶段（见 cup_profiling），命中缓存的阶段不报告
+    PROFILE_STAGES = {'scale': 'scale', 'gray': 'grayscale', 'adjust': 'gamma',
+                      'binary': 'dither', 'sobel': 'edge', 'edge': 'edge'}
+    
+    def __init__(self, workspace: Workspace = None):
+        self.workspace = workspace if workspace is not None else Workspace()
+        self._cache = {}
+        self._generations = itertools.count()
+        self.hits = dict.fromkeys(self.STAGES, 0)
+        self.misses = dict.fromkeys(self.STAGES, 0)
+    
+    def clear(self):
+        """清空缓存（计数器保留）"""
+        self._cache.clear()
+    
+    def stats(self) -> dict:
+        """各阶段的命中/未命中次数"""
+        return {name: {'hits': self.hits[name], 'misses': self.misses[name]} for name in self.STAGES}
+    
+    def _stage(self, name: str, key: tuple, compute):
+        cached = self._cache.get(name)
+        if cached is not None and cached[0] == key:
+            self.hits[name] += 1
+            return cached[1]
+        
+        self.misses[name] += 1
+        value = timed(self.PROFILE_STAGES[name], compute)
+        self._cache[name] = (key, value)
+        return value
+    
+    def scale(self, image: Image.Image, canvas_width: int, canvas_height: int,
+              scale_percent: float) -> tuple:
+        """
+        缩放阶段：返回 (阶段键, (画布数组, 原始宽度, 原始高度, 实际缩放比例))
+        缩放阶段的键含 id(image)，缓存中保留图像引用，保证不会误认新图像；
+        下游阶段只以每次重新缩放时递增的代号为键——它们不保留图像，图像释放后 id 可能被新图像复用
+        """
+        scale_key = (id(image), canvas_width, canvas_height, scale_percent)
+        scaled = self._stage('scale', scale_key, lambda: (image, scale_image_to_canvas(
+            image, canvas_width, canvas_height, scale_percent), next(self._generations)))
+        return (scaled[2],), scaled[1]
+    
+    def run(self, image: Image.Image, mode: str, canvas_width: int, canvas_height: int,
+            scale_percent: float, grid_size: int, shape: str, angle: float,
+            gamma: float, contrast: int, edge_protect: bool,
+            lo_threshold: int = 40, hi_threshold: int = 120,
+            tau_threshold: int = 60, dilate_iters: int = 0,
+            fs_serpentine: bool = True, threads: int = 1, packed: bool = False,
+            executor=None) -> tuple:
+        """
+        参数与返回值同 process_image
+        executor 不为 None（或 threads > 1，此时按 threads 共享一个线程池）时，无状态的阶段
+        （灰度、查表、有序抖动、半调、Sobel、边缘掩码）按行带并行，否则在 workspace 的缓冲区中原地计算
+        """
+        if executor is None and threads > 1:
+            executor = band_executor(threads)
+        ws = self.workspace if executor is None else None
+        
+        # 1. 缩放并居中
+        scale_key, (img_array, orig_w, orig_h, real_scale) = self.scale(
+            image, canvas_width, canvas_height, scale_percent)
+        
+        # 2. 转灰度
+        gray = self._stage('gray', scale_key, lambda: map_row_bands(
+            lambda a: to_grayscale(a, workspace=ws), (img_array,), executor=executor))
+        
+        # 3. 应用Gamma和对比度
+        adjust_key = scale_key + (contrast, gamma)
+        gray = self._stage('adjust', adjust_key, lambda: map_row_bands(
+            lambda g: apply_gamma_contrast(g, contrast, gamma, ws), (gray,), executor=executor))
+        
+        # 4. 二值化（键只包含当前模式用到的参数）
+        if mode in BAYER_MODES or mode == 'bluenoise':
+            binary_key = adjust_key + (mode,)
+        elif mode in DIFFUSION_MODES:
+            binary_key = adjust_key + (mode, fs_serpentine)
+        else:  # circle/square/cross
+            binary_key = adjust_key + ('halftone', grid_size, angle, shape)
+        binary = self._stage('binary', binary_key, lambda: PackedSticker.from_array(binarize(
+            gray, mode, canvas_width, canvas_height, grid_size, shape, angle, fs_serpentine,
+            executor, ws)))
+        
+        # 5. 边缘保护（Sobel 边缘图只取决于灰度图，单独缓存）
+        if edge_protect:
+            edge = self._stage('sobel', adjust_key, lambda: map_row_bands(
+                lambda g: sobel_magnitude(g, ws), (gray,), 1, executor))
+            edge_key = binary_key + (lo_threshold, hi_threshold, tau_threshold, dilate_iters)
+            binary = self._stage('edge', edge_key, lambda: apply_edge_protection(
+                binary, gray, lo_threshold, hi_threshold, tau_threshold, dilate_iters, edge, executor, ws))
+        
+        if not packed:
+            binary = binary.to_array()
+        return binary, orig_w, orig_h, real_scale
+
+
+# 流式处理：一带之内每个像素的工作内存上限估计（字节，半调逐像素部分最多），
+# 以及半调逐单元计算时每个晶格单元的临时内存
+STREAM_BYTES_PER_PIXEL = 160
+STREAM_BYTES_PER_CELL = 128
+
+
+def _stream_band_height(width: int, fixed_bytes: int, memory_budget: int) -> int:
+    """
+    按内存预算估算带高：扣除整幅必须保留的部分后能容纳的行数，取 64 的倍数（至少 64 行）
+    连最小带高都放不进预算时发出 RuntimeWarning（给出估计的峰值），仍按 64 行处理
+    """
+    row_bytes = max(1, width) * STREAM_BYTES_PER_PIXEL
+    rows = (memory_budget - fixed_bytes) // row_bytes
+    if rows < 64:
+        peak = fixed_bytes + 64 * row_bytes
+        warnings.warn(f"内存预算 {memory_budget / 2**20:.1f} MiB 不足：整幅必须保留的部分约 "
+                      f"{fixed_bytes / 2**20:.1f} MiB，按最小带高 64 行估计峰值约 {peak / 2**20:.1f} MiB",
+                      RuntimeWarning, stacklevel=3)
+    return max(64, rows // 64 * 64)
+
+
+def render_banded(image: Image.Image, mode: str, canvas_width: int, canvas_height: int,
+                  scale_percent: float, grid_size: int, shape: str, angle: float,
+                  gamma: float, contrast: int, edge_protect: bool,
+                  lo_threshold: int = 40, hi_threshold: int = 120,
+                  tau_threshold: int = 60, dilate_iters: int = 0,
+                  fs_serpentine: bool = True, memory_budget: int = 256 * 1024 * 1024) -> tuple:
+    """
+    流式处理：画布按行带逐带完成灰度、调整、二值化和边缘保护，整幅只保留 PIL 画布和 1 位打包的结果
+    （半调另需整幅 8 位灰度供单元取样）；误差扩散的进位缓冲区在带之间传递
+    带高按 memory_budget（字节）估算；预算连最小带高 64 行都放不下时发出 RuntimeWarning 并按 64 行处理，
+    输出与整幅处理逐位一致；计时时各带的耗时按阶段累加，Gamma/对比度查表并在灰度里
+    返回: (PackedSticker, 原始宽度, 原始高度, 实际缩放比例)
+    """
+    clock = stage_clock()
+    canvas, orig_w, orig_h, real_scale = scale_image_to_canvas_image(
+        image, canvas_width, canvas_height, scale_percent)
+    if clock:
+        clock.lap('scale')
+    w, h = canvas.size
+    lut = gamma_contrast_lut(contrast, gamma)
+    diffusion = mode in DIFFUSION_MODES
+    halftone = not diffusion and mode not in BAYER_MODES and mode != 'bluenoise'
+    
+    # 边缘保护的掩码要看到 Sobel 的 1 行和膨胀半径以外的灰度
+    halo = dilate_iters + 1 if edge_protect else 0
+    row_bytes = -(-w // 8)
+    fixed = w * h * 3 + h * row_bytes * (2 if edge_protect else 1)
+    if halftone:
+        lattice = halftone_lattice(w, h, grid_size, angle)
+        fixed += w * h + sum(arr.nbytes for arr in lattice[1:5]) + lattice.center_x.size * STREAM_BYTES_PER_CELL
+    band = _stream_band_height(w, fixed, memory_budget)
+    
+    bits = np.empty((h, row_bytes), dtype=np.uint8)
+    black_bits = np.empty((h, row_bytes), dtype=np.uint8) if edge_protect else None
+    
+    def gray_rows(a, b):
+        return to_grayscale(np.asarray(canvas.crop((0, a, w, b))), lut)
+    
+    if halftone:
+        # 单元取样可能落在任意行，先逐带求出整幅灰度，再求各单元的点
+        full_gray = np.empty((h, w), dtype=np.uint8)
+        for y0 in range(0, h, band):
+            full_gray[y0:y0 + band] = gray_rows(y0, min(h, y0 + band))
+        if clock:
+            clock.lap('grayscale')
+        gray_rows = lambda a, b: full_gray[a:b]
+        cells = _halftone_cells(full_gray, lattice, shape)
+        n_i = lattice.center_x.shape[1]
+    elif diffusion:
+        stream = ErrorDiffusionStream(w, h, DIFFUSION_MODES[mode], fs_serpentine)
+    
+    for y0 in range(0, h, band):
+        y1 = min(h, y0 + band)
+        a, b = max(0, y0 - halo), min(h, y1 + halo)
+        gray = gray_rows(a, b)
+        core = gray[y0 - a:y1 - a]
+        if clock:
+            clock.lap('grayscale')
+        
+        # 带起点是 64 的倍数，有序抖动阈值平面的相位与整幅一致
+        if mode in BAYER_MODES:
+            bits[y0:y1] = np.packbits(dither_bayer(core, BAYER_MODES[mode]) >= 128, axis=-1)
+        elif mode == 'bluenoise':
+            bits[y0:y1] = np.packbits(dither_blue_noise(core) >= 128, axis=-1)
+        elif diffusion:
+            done, rows = stream.feed(core)
+            bits[done:done + len(rows)] = np.packbits(rows >= 128, axis=-1)
+        else:
+            cell_index, dist_sq = halftone_pixel_cells(lattice, w, y0, y1)
+            py = np.arange(y0, y1, dtype=np.float64)[:, None]
+            rows = _halftone_rows(cell_index, dist_sq, py, n_i, cells)
+            bits[y0:y1] = np.packbits(rows >= 128, axis=-1)
+        if clock:
+            clock.lap('dither')
+        
+        if edge_protect:
+            black_mask, _ = build_edge_mask(gray, lo_threshold, hi_threshold, tau_threshold)
+            if dilate_iters > 0:
+                black_mask = dilate_mask(black_mask.view(np.uint8), dilate_iters) > 0
+            black_bits[y0:y1] = np.packbits(black_mask[y0 - a:y1 - a], axis=-1)
+            if clock:
+                clock.lap('edge')
+    
+    # 只加黑，不改白
+    if edge_protect:
+        bits &= np.invert(black_bits, out=black_bits)
+        if clock:
+            clock.lap('edge')
+    return PackedSticker(bits, w), orig_w, orig_h, real_scale
+
+
+# 自动模式：候选 (模式, 半调形状)，便宜的在前；调整网格为用户 Gamma 的倍数与对比度的增量
+AUTO_CANDIDATES = (
+    ('bayer', 'circle'), ('bluenoise', 'circle'),
+    ('circle', 'circle'), ('circle', 'square'), ('circle', 'cross'),
+    ('fs', 'circle'), ('atkinson', 'circle'),
+)
+AUTO_GAMMA_FACTORS = (1.0, 0.85, 1.2)
+AUTO_CONTRAST_OFFSETS = (0, 20)
+AUTO_TIME_BUDGET = 0.5  # 秒
+AUTO_BLUR_RADIUS = 3
+
+
+@lru_cache(maxsize=4)
+def _auto_executor(threads: int) -> ThreadPoolExecutor:
+    """自动模式候选专用的线程池"""
+    return ThreadPoolExecutor(max_workers=threads, thread_name_prefix='cup-auto')
+
+
+def blurred_error(binary: np.ndarray, reference: np.ndarray, radius: int = AUTO_BLUR_RADIUS) -> float:
+    """
+    感知误差：二值图与参考灰度之差经 (2r+1)×(2r+1) 方框模糊后的均方根（只取完整窗口）
+    模糊近似人眼在观看距离上对网点的平均，值越小，二值图看上去越接近参考灰度
+    """
+    diff = binary.astype(np.int32)
+    diff -= reference
+    k = 2 * radius + 1
+    sat = integral_image(diff, np.int32)
+    sums = box_sum(sat, slice(None, -k), slice(k, None), slice(None, -k), slice(k, None))
+    sums = sums.astype(np.float32).ravel()
+    return float(np.sqrt(np.dot(sums, sums) / sums.size)) / (k * k)
+
+
+def auto_candidates(gamma: float, contrast: int) -> list:
+    """
+    自动模式的候选列表 [(模式, 形状, gamma, 对比度), ...]，按尝试顺序排列：
+    先是用户当前调整下的各模式，再是调整网格中的其他组合
+    """
+    adjustments = [(gamma * f, int(np.clip(contrast + d, -100, 100)))
+                   for f in AUTO_GAMMA_FACTORS for d in AUTO_CONTRAST_OFFSETS]
+    adjustments = list(dict.fromkeys(adjustments))
+    return [(mode, shape, g, c) for g, c in adjustments for mode, shape in AUTO_CANDIDATES]
+
+
+def auto_render(image: Image.Image, canvas_width: int, canvas_height: int,
+                scale_percent: float, grid_size: int, angle: float,
+                gamma: float, contrast: int, edge_protect: bool,
+                lo_threshold: int = 40, hi_threshold: int = 120,
+                tau_threshold: int = 60, dilate_iters: int = 0,
+                fs_serpentine: bool = True, threads: int = None,
+                time_budget: float = AUTO_TIME_BUDGET, pipeline: RenderPipeline = None,
+                executor=None, scaled: tuple = None) -> tuple:
+    """
+    自动模式：在时间预算内并行渲染各模式及一小组 Gamma/对比度组合，
+    以用户调整后的灰度为参考按 blurred_error 打分，返回误差最小的一个
+    画布只缩放一次（传入 pipeline 时复用其缓存的缩放结果）；到期时未开始的候选直接放弃，
+    至少等到一个候选完成，因此结果可能随机器速度不同
+    计时时参考灰度计入 grayscale，各候选在线程池中的渲染与打分整体计入 dither
+    threads: 候选并行的线程数（默认 CPU 核数）；executor: 指定线程池（默认为自动模式专用的线程池，
+    到期仍在运行的候选不占用行带并行的 band_executor）；除第一个候选外，出错的候选不参与比较
+    scaled: 已缩放好的 (画布数组, 原始宽度, 原始高度, 实际缩放比例)（如 RenderPipeline.scale 的结果），
+    给出时不再缩放、不使用 pipeline；后台线程调用时应在界面线程取好画布再传入
+    
+    返回: (PackedSticker, 原始宽度, 原始高度, 实际缩放比例, 选择信息 dict)
+    """
+    deadline = time.perf_counter() + time_budget
+    if scaled is None:
+        if pipeline is None:
+            pipeline = RenderPipeline()
+        _, scaled = pipeline.scale(image, canvas_width, canvas_height, scale_percent)
+    img_array, orig_w, orig_h, real_scale = scaled
+    clock = stage_clock()
+    reference = to_grayscale(img_array, gamma_contrast_lut(contrast, gamma))
+    if clock:
+        clock.lap('grayscale')
+    
+    def expired(required):
+        return not required and time.perf_counter() > deadline
+    
+    def render(mode, shape, g, c, required=False):
+        # 每步之前检查预算，到期仍在运行的候选尽早结束，不拖慢下一次自动渲染
+        if expired(required):
+            return None
+        gray = to_grayscale(img_array, gamma_contrast_lut(c, g))
+        if expired(required):
+            return None
+        binary = binarize(gray, mode, canvas_width, canvas_height, grid_size, shape, angle, fs_serpentine)
+        if expired(required):
+            return None
+        if edge_protect:
+            binary = apply_edge_protection(binary, gray, lo_threshold, hi_threshold,
+                                           tau_threshold, dilate_iters)
+        return blurred_error(binary, reference), binary
+    
+    if executor is None:
+        executor = _auto_executor(threads or os.cpu_count() or 1)
+    candidates = auto_candidates(gamma, contrast)
+    # 第一个候选（用户当前调整下最便宜的模式）不受预算限制，保证总有结果
+    futures = [executor.submit(render, *candidates[0], required=True)]
+    futures += [executor.submit(render, *cand) for cand in candidates[1:]]
+    
+    wait(futures, timeout=max(0.0, deadline - time.perf_counter()))
+    for future in futures[1:]:
+        future.cancel()
+    # 第一个候选出错时照常抛出；其余出错的候选跳过
+    results = [(f.result(), cand) for f, cand in zip(futures, candidates)
+               if f is futures[0] or (f.done() and not f.cancelled() and f.exception() is None
+                                      and f.result() is not None)]
+    
+    (score, binary), (mode, shape, g, c) = min(results, key=lambda r: r[0][0])
+    choice = dict(mode=mode, shape=shape, gamma=g, contrast=c, score=score,
+                  scored=len(results), total=len(candidates))
+    sticker = PackedSticker.from_array(binary)
+    if clock:
+        clock.lap('dither')
+    return sticker, orig_w, orig_h, real_scale, choice
+
+
 def process_image(image: Image.Image, mode: str, canvas_width: int, canvas_height: int,
                  scale_percent: float, grid_size: int, shape: str, angle: float,
                  gamma: float, contrast: int, edge_protect: bool,
                  lo_threshold: int = 40, hi_threshold: int = 120,
                  tau_threshold: int = 60, dilate_iters: int = 0,
-                 fs_serpentine: bool = True) -> tuple:
+                 fs_serpentine: bool = True, threads: int = 1,
+                 pipeline: RenderPipeline = None, packed: bool = False,
+                 cache=None, executor=None, workspace: Workspace = None,
+                 memory_budget: int = None, timings=None) -> tuple:
     """
     主处理函数：处理图像并返回处理后的图像和预览信息
+    image 可以是 PIL 图像或 SourcePyramid
+    threads: 并行线程数；无状态阶段按行带并行，误差扩散总是串行（逐像素依赖，
+    多线程波前的线程交接开销超过 Numba 串行版本的总耗时；多张图的吞吐量靠 process_images 按图并行）
+    executor: 指定行带并行使用的线程池（默认按 threads 共享一个）；结果与单线程完全一致
+    pipeline: 传入 RenderPipeline 时复用其中缓存的各阶段结果
+    workspace: 未传 pipeline 时，新管线使用的临时缓冲区（批量处理时每个线程复用一个）
+    packed: 为 True 时返回 PackedSticker 而不是 0/255 数组
+    cache: 传入 cup_render_cache.RenderCache 时先查磁盘缓存，未命中再计算并写回
+    memory_budget: 给定（字节）时改用按行带的流式处理（见 render_banded），不使用 pipeline
+    mode='auto' 时在时间预算内挑选误差最小的模式与调整（见 auto_render），threads/executor 用于候选并行；
+    结果取决于预算内完成了哪些候选，不读写 cache
+    timings: callback(阶段, 秒)，报告各阶段（scale、grayscale、gamma、dither、edge）的耗时；
+    也可在外面用 cup_profiling.stage_timings() 收集，命中缓存的阶段不报告
     
     返回: (处理后的二值化图像数组, 原始宽度, 原始高度, 实际缩放比例)
     """
-    # 1. 缩放并居中
-    img_array, orig_w, orig_h, real_scale = scale_image_to_canvas(image, canvas_width, canvas_height, scale_percent)
+    params = dict(mode=mode, canvas_width=canvas_width, canvas_height=canvas_height,
+                  scale_percent=scale_percent, grid_size=grid_size, shape=shape, angle=angle,
+                  gamma=gamma, contrast=contrast, edge_protect=edge_protect,
+                  lo_threshold=lo_threshold, hi_threshold=hi_threshold,
+                  tau_threshold=tau_threshold, dilate_iters=dilate_iters,
+                  fs_serpentine=fs_serpentine)
     
-    # 2. 转灰度
-    gray = to_grayscale(img_array)
+    if timings is not None:
+        with stage_timings(timings):
+            return process_image(image, **params, threads=threads, pipeline=pipeline, packed=packed,
+                                 cache=cache, executor=executor, workspace=workspace,
+                                 memory_budget=memory_budget)
     
-    # 3. 应用Gamma和对比度
-    gray = apply_gamma_contrast(gray, contrast, gamma)
+    if mode == 'auto':
+        cache = None
+    if cache is not None:
+        key = cache.key_for(image, params)
+        hit = cache.get(key)
+        if hit is not None:
+            sticker, orig_w, orig_h, real_scale = hit
+            return (sticker if packed else sticker.to_array()), orig_w, orig_h, real_scale
     
-    # 4. 二值化
-    if mode == 'bayer':
-        binary = dither_bayer(gray)
-    elif mode == 'fs':
-        binary = dither_floyd_steinberg(gray, fs_serpentine)
-    else:  # circle/square/cross
-        binary = circle_halftone(gray, canvas_width, canvas_height, grid_size, angle, shape)
+    if mode == 'auto':
+        result = auto_render(image, canvas_width, canvas_height, scale_percent, grid_size, angle,
+                             gamma, contrast, edge_protect, lo_threshold, hi_threshold,
+                             tau_threshold, dilate_iters, fs_serpentine, threads=threads,
+                             pipeline=pipeline, executor=executor)[:4]
+    elif memory_budget is not None:
+        result = render_banded(image, **params, memory_budget=memory_budget)
+    else:
+        if pipeline is None:
+            pipeline = RenderPipeline(workspace)
+        result = pipeline.run(image, **params, threads=threads, packed=True, executor=executor)
     
-    # 5. 边缘保护
-    if edge_protect:
-        binary = apply_edge_protection(binary, gray, lo_threshold, hi_threshold, tau_threshold, dilate_iters)
+    if cache is not None:
+        cache.put(key, *result)
+    if not packed:
+        result = (result[0].to_array(),) + result[1:]
+    return result
+
+
+# 批量处理时每块的像素数：逐像素运算受内存带宽限制，一块的中间数组能留在缓存里时最快
+# （小画布可堆叠十几张；596×832 的画布一块一张，只省去逐张调用的开销）
+BATCH_CHUNK_PIXELS = 1 << 18
+
+
+def _per_image_values(value, n: int, name: str) -> list:
+    """参数为单个值时所有图共用，为序列时逐张指定（长度须为 n）"""
+    if isinstance(value, (list, tuple, np.ndarray)):
+        if len(value) != n:
+            raise ValueError(f"{name} 有 {len(value)} 个取值，但共有 {n} 张图")
+        # 数组取值转成 Python 标量，缓存键与逐张处理时一致
+        return value.tolist() if isinstance(value, np.ndarray) else list(value)
+    return [value] * n
+
+
+def _param_groups(keys: list) -> list:
+    """
+    按参数键把图像分组：[(键, 下标), ...]；只有一组时下标为 slice(None)，切片不复制
+    """
+    groups = {}
+    for i, key in enumerate(keys):
+        groups.setdefault(key, []).append(i)
+    if len(groups) == 1:
+        return [(keys[0], slice(None))]
+    return [(key, np.array(index)) for key, index in groups.items()]
+
+
+def _process_stack(images: list, params: list, canvas_width: int, canvas_height: int,
+                   workspace: Workspace = None) -> tuple:
+    """
+    批量处理一块图像：画布堆成 (N, H, W, 3)，各阶段按参数相同的组整组计算
+    返回 ((N, H, W) 的 0/255 数组, [(原始宽度, 原始高度, 实际缩放比例), ...])；
+    数组可能是 workspace 中的缓冲区，下一块计算前须取走
+    """
+    clock = stage_clock()
+    n = len(images)
+    canvases = _scratch(workspace, 'batch_canvas', (n, canvas_height, canvas_width, 3), np.uint8)
+    info = []
+    for i, (image, p) in enumerate(zip(images, params)):
+        canvas, orig_w, orig_h, real_scale = scale_image_to_canvas_image(
+            image, canvas_width, canvas_height, p['scale_percent'])
+        canvases[i] = np.asarray(canvas)
+        info.append((orig_w, orig_h, real_scale))
+    if clock:
+        clock.lap('scale')
     
-    return binary, orig_w, orig_h, real_scale
+    # 灰度 + Gamma/对比度（Gamma/对比度全部相同时查表合并在灰度那一遍里）
+    adjust_groups = _param_groups([(p['contrast'], p['gamma']) for p in params])
+    if len(adjust_groups) == 1:
+        gray = to_grayscale(canvases, gamma_contrast_lut(params[0]['contrast'], params[0]['gamma']), workspace)
+        if clock:
+            clock.lap('grayscale')
+    else:
+        gray = to_grayscale(canvases, workspace=workspace)
+        if clock:
+            clock.lap('grayscale')
+        for (contrast, gamma), index in adjust_groups:
+            gray[index] = gamma_contrast_lut(contrast, gamma).take(gray[index])
+        if clock:
+            clock.lap('gamma')
+    del canvases
+    
+    # 二值化：有序抖动、蓝噪声整组一次比较；半调同一屏幕参数共用晶格；误差扩散逐张
+    binary_keys = [(p['mode'],) if p['mode'] in BAYER_MODES or p['mode'] == 'bluenoise'
+                   else (p['mode'], p['fs_serpentine']) if p['mode'] in DIFFUSION_MODES
+                   else ('halftone', p['grid_size'], p['angle'], p['shape']) for p in params]
+    binary_groups = _param_groups(binary_keys)
+    if len(binary_groups) > 1:
+        binary = np.empty(gray.shape, dtype=np.uint8)
+    for _, index in binary_groups:
+        p = params[0] if isinstance(index, slice) else params[index[0]]
+        result = binarize(gray[index], p['mode'], canvas_width, canvas_height, p['grid_size'],
+                          p['shape'], p['angle'], p['fs_serpentine'], workspace=workspace)
+        if len(binary_groups) > 1:
+            binary[index] = result
+        else:
+            binary = result
+    if clock:
+        clock.lap('dither')
+    
+    # 边缘保护（Sobel、掩码、膨胀都按整组计算）
+    edge_keys = [(p['edge_protect'], p['lo_threshold'], p['hi_threshold'], p['tau_threshold'],
+                  p['dilate_iters']) for p in params]
+    for (edge_protect, lo, hi, tau, dilate_iters), index in _param_groups(edge_keys):
+        if edge_protect:
+            binary[index] = apply_edge_protection(binary[index], gray[index], lo, hi, tau, dilate_iters,
+                                                  workspace=workspace)
+            if clock:
+                clock.lap('edge')
+    
+    return binary, info
 
 
-def generate_print_preview(binary: np.ndarray, label_width: int = 360, label_height: int = 760) -> Image.Image:
+def process_images(images: list, mode, canvas_width: int, canvas_height: int,
+                   scale_percent, grid_size, shape, angle, gamma, contrast, edge_protect,
+                   lo_threshold=40, hi_threshold=120, tau_threshold=60, dilate_iters=0,
+                   fs_serpentine=True, threads: int = 1, executor=None,
+                   packed: bool = False, cache=None) -> tuple:
     """
-    生成打印效果预览（模拟36×76mm标签贴）
-    对应HTML版本的 downsamplePreview() 函数
+    批量处理：画布尺寸相同的多张图堆成 (N, H, W) 一起计算，省去逐张调用的解释器开销
+    除画布尺寸外的参数都可以是单个值（所有图共用）或长度为 N 的序列（逐张指定）；
+    参数相同的图整组计算（灰度、查表、有序抖动、半调、边缘保护），误差扩散仍逐张进行
+    图像按 BATCH_CHUNK_PIXELS 分块处理，每个线程复用一个 workspace；threads > 1 或传入 executor 时各块并行
+    每张的结果与 process_image 相同；不支持 mode='auto'
+    计时（cup_profiling.stage_timings）按块报告，同一次调用的各块在收集器中累加
+    cache: 传入 cup_render_cache.RenderCache 时先逐张查磁盘缓存（键与 process_image 相同），
+    只把未命中的图堆叠计算，算完写回
+    
+    返回: ((N, H, W) 的 0/255 数组，packed 时为 PackedSticker 列表, [(原始宽度, 原始高度, 实际缩放比例), ...])
     """
-    h, w = binary.shape
-    
-    # 1. 创建标签背景 #eaeaea
-    preview = Image.new('RGB', (label_width, label_height), (234, 234, 234))
-    
-    # 2. 降采样原图（1.01倍降采样率）
-    ratio = 1.01
-    new_w = int(w / ratio)
-    new_h = int(h / ratio)
-    
-    # 创建降采样数据（灰度）
-    downsampled = np.zeros((new_h, new_w), dtype=np.uint8)
-    
-    for dy in range(new_h):
-        for dx in range(new_w):
-            # 计算源图像的采样范围
-            sx0 = int(np.floor(dx * ratio))
-            sy0 = int(np.floor(dy * ratio))
-            sx1 = min(w, int(np.ceil((dx + 1) * ratio)))
-            sy1 = min(h, int(np.ceil((dy + 1) * ratio)))
-            
-            # 计算平均值
-            sample_sum = 0.0
-            count = 0
-            for py in range(sy0, sy1):
-                for px in range(sx0, sx1):
-                    sample_sum += float(binary[py, px])
-                    count += 1
-            
-            avg = sample_sum / count if count > 0 else 255
-            
-            # 二值化：avg > 128 为白(234=0xEA)，否则为黑(0)
-            downsampled[dy, dx] = 234 if avg > 128 else 0
+    images = list(images)
+    n = len(images)
+    values = dict(mode=mode, scale_percent=scale_percent, grid_size=grid_size, shape=shape,
+                  angle=angle, gamma=gamma, contrast=contrast, edge_protect=edge_protect,
+                  lo_threshold=lo_threshold, hi_threshold=hi_threshold,
+                  tau_threshold=tau_threshold, dilate_iters=dilate_iters,
+                  fs_serpentine=fs_serpentine)
+    columns = {name: _per_image_values(value, n, name) for name, value in values.items()}
+    params = [{name: columns[name][i] for name in columns} for i in range(n)]
+    if any(p['mode'] == 'auto' for p in params):
+        raise ValueError("批量处理不支持 auto 模式")
     
-    # 转换为PIL Image（灰度）
-    down_img = Image.fromarray(downsampled, 'L')
+    out = None if packed else np.empty((n, canvas_height, canvas_width), dtype=np.uint8)
+    stickers = [None] * n
+    info = [None] * n
+    keys = [None] * n
+    todo = list(range(n))
+    if cache is not None:
+        todo = []
+        for i, (image, p) in enumerate(zip(images, params)):
+            keys[i] = cache.key_for(image, dict(p, canvas_width=canvas_width,
+                                                canvas_height=canvas_height))
+            hit = cache.get(keys[i])
+            if hit is None:
+                todo.append(i)
+                continue
+            stickers[i], info[i] = hit[0], hit[1:]
+            if out is not None:
+                out[i] = hit[0].to_array()
     
-    # 3. 计算缩放参数
-    scale = label_width / new_w
-    scaled_h = int(new_h * scale)
-    offset_y = int((label_height - scaled_h) / 2)
+    chunk = max(1, BATCH_CHUNK_PIXELS // max(1, canvas_width * canvas_height))
+    local = threading.local()
     
-    # 4. 缩放并粘贴到标签中心
-    down_img_resized = down_img.resize((label_width, scaled_h), Image.Resampling.LANCZOS)
-    preview.paste(down_img_resized, (0, offset_y))
+    def run(start):
+        if not hasattr(local, 'workspace'):
+            local.workspace = Workspace()
+        index = todo[start:start + chunk]
+        binary, chunk_info = _process_stack([images[i] for i in index], [params[i] for i in index],
+                                            canvas_width, canvas_height, local.workspace)
+        # binary 在 workspace 中，下一块会覆盖，逐张拷出或打包
+        for i, b, item in zip(index, binary, chunk_info):
+            info[i] = item
+            if out is not None:
+                out[i] = b
+            if packed or cache is not None:
+                stickers[i] = PackedSticker.from_array(b)
     
-    # 5. 绘制取餐号码（仅当顶部有足够空白时）
-    from PIL import ImageDraw, ImageFont
-    draw = ImageDraw.Draw(preview)
+    if executor is None and threads > 1:
+        executor = band_executor(threads)
+    starts = range(0, len(todo), chunk)
+    if executor is not None:
+        # 工作线程带上调用者的上下文（计时接收者），每块一份副本
+        futures = [executor.submit(contextvars.copy_context().run, run, start) for start in starts]
+        for future in futures:
+            future.result()
+    else:
+        for start in starts:
+            run(start)
     
-    if offset_y > 30:
-        try:
-            # 尝试使用系统字体，大小56
-            font = ImageFont.truetype('/System/Library/Fonts/Helvetica.ttc', 56)
-        except:
-            # 如果找不到，使用默认字体
-            font = ImageFont.load_default()
-        
-        draw.text((30, 40), '8188', fill='black', font=font)
+    if cache is not None:
+        for i in todo:
+            cache.put(keys[i], stickers[i], *info[i])
+    return (stickers if packed else out), info
+
+
+# 启动时映射已有的蓝噪声文件（不存在时留到第一次使用再生成）
+load_blue_noise(generate=False)
+
+
+def integral_image(values: np.ndarray, dtype=np.int64) -> np.ndarray:
+    """
+    积分图（summed-area table）：sat[..., y, x] = values[..., :y, :x] 之和，形状各维 +1
+    任意矩形的和只需 4 次查表，见 box_sum()
+    dtype 须能容纳整幅的和（8 位画布用 int32 即可）
+    """
+    shape = values.shape[:-2] + (values.shape[-2] + 1, values.shape[-1] + 1)
+    sat = np.zeros(shape, dtype=dtype)
+    np.cumsum(values, axis=-2, dtype=dtype, out=sat[..., 1:, 1:])
+    np.cumsum(sat[..., 1:, 1:], axis=-1, out=sat[..., 1:, 1:])
+    return sat
+
+
+def box_sum(sat: np.ndarray, y0, y1, x0, x1) -> np.ndarray:
+    """
+    用积分图求 [y0, y1) × [x0, x1) 矩形内的和（下标可为可广播的数组）
+    """
+    return sat[..., y1, x1] - sat[..., y0, x1] - sat[..., y1, x0] + sat[..., y0, x0]
+
+
+@lru_cache(maxsize=8)
+def _preview_windows(width: int, height: int, ratio: float) -> tuple:
+    """
+    打印预览降采样窗口：每个输出像素对应的源范围 [s0, s1)，返回只读数组
+    """
+    new_w = int(width / ratio)
+    new_h = int(height / ratio)
+    windows = []
+    for n, size in ((new_h, height), (new_w, width)):
+        d = np.arange(n, dtype=np.float64)
+        lo = np.floor(d * ratio).astype(np.intp)
+        hi = np.minimum(size, np.ceil((d + 1) * ratio)).astype(np.intp)
+        lo.setflags(write=False)
+        hi.setflags(write=False)
+        windows.append((lo, hi))
+    return tuple(windows)
+
+
+def downsample_preview(binary, ratio: float = 1.01) -> np.ndarray:
+    """
+    打印预览的面积平均降采样：每个窗口均值 > 128 为白(234=0xEA)，否则为黑(0)
+    binary 可以是 0/255 数组或 PackedSticker
+    """
+    return _kernel('preview_downsample')(binary, ratio)
+
+
+@register_kernel('preview_downsample', 'numpy')
+def _downsample_preview_numpy(binary, ratio: float = 1.01) -> np.ndarray:
+    """
+    用积分图一次求出所有窗口的和
+    """
+    if isinstance(binary, PackedSticker):
+        # 直接统计白色位数，每个白像素计 255
+        values = np.unpackbits(binary.bits, axis=-1, count=binary.width)
+        unit = 255
+    else:
+        values = binary
+        unit = 1
+    h, w = values.shape
     
-    # 6. 绘制打印误差警告区域（左右各6%）
-    warning_width = int(label_width * 0.06)
-    warning_color = (255, 100, 100, 102)  # 半透明红色
+    (y0, y1), (x0, x1) = _preview_windows(w, h, ratio)
+    sat = integral_image(values)
+    sample_sum = box_sum(sat, y0[:, None], y1[:, None], x0[None, :], x1[None, :]) * unit
+    count = (y1 - y0)[:, None] * (x1 - x0)[None, :]
+    avg = sample_sum / count
     
-    # 转换为RGBA以支持透明度
-    preview_rgba = preview.convert('RGBA')
-    warning_overlay = Image.new('RGBA', (label_width, label_height), (0, 0, 0, 0))
-    warning_draw = ImageDraw.Draw(warning_overlay)
+    downsampled = np.zeros(avg.shape, dtype=np.uint8)
+    downsampled[avg > 128] = 234
+    return downsampled
+
+
+# 打印预览标签的固定元素
+LABEL_BACKGROUND = (234, 234, 234)  # #eaeaea
+PICKUP_NUMBER = '8188'
+WARNING_COLOR = (255, 100, 100, 102)  # 半透明红色
+
+
+@lru_cache(maxsize=1)
+def _pickup_font():
+    """
+    取餐号码字体（只加载一次）
+    """
+    try:
+        # 尝试使用系统字体，大小56
+        return ImageFont.truetype('/System/Library/Fonts/Helvetica.ttc', 56)
+    except OSError:
+        # 如果找不到，使用默认字体
+        return ImageFont.load_default()
+
+
+@lru_cache(maxsize=1)
+def _pickup_number_bottom() -> int:
+    """
+    取餐号码在标签上所占区域的下边界
+    """
+    scratch = ImageDraw.Draw(Image.new('L', (1, 1)))
+    return scratch.textbbox((30, 40), PICKUP_NUMBER, font=_pickup_font())[3]
+
+
+@lru_cache(maxsize=8)
+def _warning_overlay(label_width: int, label_height: int) -> Image.Image:
+    """
+    打印误差警告区域（左右各6%）的 RGBA 图层
+    """
+    warning_width = int(label_width * 0.06)
+    overlay = Image.new('RGBA', (label_width, label_height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(overlay)
     
     # 左侧警告区域
-    warning_draw.rectangle([0, 0, warning_width, label_height], fill=warning_color)
+    draw.rectangle([0, 0, warning_width, label_height], fill=WARNING_COLOR)
     
     # 右侧警告区域
-    warning_draw.rectangle([label_width - warning_width, 0, label_width, label_height], fill=warning_color)
+    draw.rectangle([label_width - warning_width, 0, label_width, label_height], fill=WARNING_COLOR)
     
-    # 合成
-    preview_rgba = Image.alpha_composite(preview_rgba, warning_overlay)
-    preview = preview_rgba.convert('RGB')
+    return overlay
+
+
+def _decorate_label(region: Image.Image, label_width: int, label_height: int,
+                    top: int, with_number: bool) -> Image.Image:
+    """
+    在标签的一段横条（从第 top 行开始的 RGB 图像）上绘制取餐号码和警告区域
+    """
+    # 号码只落在标签顶部，横条不与它相交时无需绘制
+    if with_number and _pickup_number_bottom() > top:
+        draw = ImageDraw.Draw(region)
+        draw.text((30, 40 - top), PICKUP_NUMBER, fill='black', font=_pickup_font())
+    
+    overlay = _warning_overlay(label_width, label_height)
+    if top != 0 or region.height != label_height:
+        overlay = overlay.crop((0, top, label_width, top + region.height))
+    
+    return Image.alpha_composite(region.convert('RGBA'), overlay).convert('RGB')
+
+
+@lru_cache(maxsize=8)
+def _label_template(label_width: int, label_height: int, with_number: bool) -> Image.Image:
+    """
+    预合成的空白标签：背景 + 取餐号码 + 警告区域（按标签尺寸缓存，使用时复制）
+    """
+    background = Image.new('RGB', (label_width, label_height), LABEL_BACKGROUND)
+    return _decorate_label(background, label_width, label_height, 0, with_number)
+
+
+def generate_print_preview(binary: np.ndarray, label_width: int = 360, label_height: int = 760) -> Image.Image:
+    """
+    生成打印效果预览（模拟36×76mm标签贴）
+    对应HTML版本的 downsamplePreview() 函数
+    binary 可以是 0/255 数组或 PackedSticker
+    计时时整体报告为 preview 阶段
+    """
+    clock = stage_clock()
+    
+    # 1. 降采样原图（1.01倍降采样率）
+    downsampled = downsample_preview(binary)
+    new_h, new_w = downsampled.shape
+    
+    # 转换为PIL Image（灰度）
+    down_img = Image.fromarray(downsampled, 'L')
     
+    # 2. 计算缩放参数
+    scale = label_width / new_w
+    scaled_h = int(new_h * scale)
+    offset_y = int((label_height - scaled_h) / 2)
+    
+    # 3. 取预合成的标签模板（取餐号码仅当顶部有足够空白时绘制）
+    with_number = offset_y > 30
+    preview = _label_template(label_width, label_height, with_number).copy()
+    
+    # 4. 缩放后补上覆盖在杯贴上的号码和警告区域，粘贴到标签中心
+    down_img_resized = down_img.resize((label_width, scaled_h), Image.Resampling.LANCZOS)
+    sticker = _decorate_label(down_img_resized.convert('RGB'), label_width, label_height,
+                              offset_y, with_number)
+    preview.paste(sticker, (0, offset_y))
+    
+    if clock:
+        clock.lap('preview')
     return preview
+
+
+# ===== 逐像素内核：同一段代码解释执行为 reference 后端，Numba 编译后为 numba 后端 =====
+
+@lru_cache(maxsize=None)
+def _diffusion_arrays(kernel: str) -> tuple:
+    """扩散核拆成 (dx 数组, dy 数组, 分子数组, 分母)，供逐像素内核使用"""
+    terms, divisor = DIFFUSION_KERNELS[kernel]
+    dxs, dys, nums = (np.array(column, dtype=np.int64) for column in zip(*terms))
+    return dxs, dys, nums, divisor
+
+
+# 半调形状 -> halftone_loop 的形状编号（其余按圆形处理）
+_HALFTONE_SHAPE_CODES = {'square': 1, 'cross': 2}
+
+
+def _per_image(fn):
+    """
+    只接受二维数组的内核：输入有前导轴（多张图）时逐张调用后堆叠
+    """
+    def run(arr, *args):
+        if arr.ndim == 2:
+            return fn(arr, *args)
+        results = np.stack([fn(a, *args) for a in arr.reshape((-1,) + arr.shape[-2:])])
+        return results.reshape(arr.shape[:-2] + results.shape[1:])
+    return run
+
+
+def _halftone_loop_kernel(halftone_loop):
+    """
+    逐像素半调内核的包装：传入 executor 时按行带并行（每带调用一次，只绘制本带的行；
+    Numba 版本编译为 nogil，各带可真正并行），多张图的堆叠逐张处理、不分带
+    """
+    def run(gray, canvas_width, canvas_height, cell, angle_deg, shape, executor=None, workspace=None):
+        code = _HALFTONE_SHAPE_CODES.get(shape, 0)
+        if gray.ndim > 2:
+            return _per_image(halftone_loop)(gray, cell, float(angle_deg), code, 0, gray.shape[-2])
+        rows = np.arange(gray.shape[0])
+        return map_row_bands(lambda r: halftone_loop(gray, cell, float(angle_deg), code, int(r[0]), int(r[-1]) + 1),
+                             (rows,), executor=executor)
+    return run
+
+
+def _loop_kernels(loop) -> dict:
+    """
+    把逐像素内核包装成与公开函数参数相同的实现（多张图的堆叠逐张处理）
+    半调按 executor 分行带并行；误差扩散串行；
+    有序抖动、Sobel 等由调用方（binarize、RenderPipeline）经 map_row_bands 分带，与 numpy 后端相同
+    """
+    halftone = _halftone_loop_kernel(loop['halftone'])
+    loop = {name: _per_image(fn) for name, fn in loop.items()}
+    return {
+        'bayer': lambda gray, size=8: loop['bayer'](gray, bayer_matrix(size)),
+        'error_diffusion': lambda gray, kernel='floyd-steinberg', serpentine=True:
+            loop['error_diffusion'](gray, *_diffusion_arrays(kernel), serpentine),
+        'sobel': lambda gray, workspace=None: loop['sobel'](gray),
+        'dilate': lambda mask, iterations=1: loop['dilate'](mask, iterations),
+        'halftone': halftone,
+        'preview_downsample': lambda binary, ratio=1.01: loop['preview_downsample'](
+            binary.to_array() if isinstance(binary, PackedSticker) else binary, ratio),
+    }
+
+
+_reference_loops = {
+    'bayer': cup_kernels.bayer_loop,
+    'error_diffusion': cup_kernels.error_diffusion_loop,
+    'sobel': cup_kernels.sobel_loop,
+    'dilate': cup_kernels.dilate_loop,
+    'halftone': cup_kernels.halftone_loop,
+    'preview_downsample': cup_kernels.preview_downsample_loop,
+}
+for _name, _impl in _loop_kernels(_reference_loops).items():
+    register_kernel(_name, 'reference')(_impl)
+
+if cup_kernels.numba is not None:
+    _numba_loops = {name: cup_kernels.compile_kernel(fn) for name, fn in _reference_loops.items()}
+    for _name, _impl in _loop_kernels(_numba_loops).items():
+        register_kernel(_name, 'numba')(_impl)
+
+select_backend()
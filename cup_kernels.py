@@ -0,0 +1,260 @@
+"""
+杯贴图像处理的逐像素参考内核
+按原始算法逐像素实现，只用标量运算和下标访问，既可直接用 Python 解释执行（reference 后端，
+用于核对结果），也可交给 Numba 编译（numba 后端）；安装了 Numba 时 compile_kernel 返回编译版本
+"""
+
+import math
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def compile_kernel(fn):
+    """
+    用 Numba 编译内核（释放 GIL，可在行带线程池中并行）；未安装 Numba 时返回 None
+    """
+    if numba is None:
+        return None
+    try:
+        return numba.njit(cache=True, nogil=True)(fn)
+    except RuntimeError:
+        # 无处写入编译缓存（如打包后的只读目录）时每次启动重新编译
+        return numba.njit(nogil=True)(fn)
+
+
+def bayer_loop(gray, ranks):
+    """
+    有序抖动：像素 >= (排名 + 0.5) * 256 / n 为白
+    """
+    h, w = gray.shape
+    n_y, n_x = ranks.shape
+    scale = 256.0 / (n_y * n_x)
+    binary = np.zeros((h, w), dtype=np.uint8)
+    
+    for y in range(h):
+        for x in range(w):
+            threshold = (ranks[y % n_y, x % n_x] + 0.5) * scale
+            if gray[y, x] >= threshold:
+                binary[y, x] = 255
+    
+    return binary
+
+
+def error_diffusion_loop(gray, dxs, dys, nums, divisor, serpentine):
+    """
+    误差扩散：按扫描顺序逐像素阈值化，误差按 (dx, dy, 分子) / 分母 推给后续像素
+    （float64 累加，与查表驱动的行版本逐位一致）
+    """
+    h, w = gray.shape
+    g = gray.astype(np.float64)
+    binary = np.zeros((h, w), dtype=np.uint8)
+    n_terms = len(nums)
+    
+    for y in range(h):
+        reverse = serpentine and y % 2 == 1
+        for i in range(w):
+            x = w - 1 - i if reverse else i
+            err = g[y, x]
+            if err >= 128:
+                binary[y, x] = 255
+                err -= 255
+            
+            # 分散误差到周围像素（反向行左右镜像）
+            for k in range(n_terms):
+                tx = x - dxs[k] if reverse else x + dxs[k]
+                ty = y + dys[k]
+                if 0 <= tx < w and ty < h:
+                    g[ty, tx] += err * nums[k] / divisor
+    
+    return binary
+
+
+def sobel_loop(gray):
+    """
+    Sobel边缘检测：|gx| + |gy| 截断到 255，边框为 0
+    """
+    h, w = gray.shape
+    g = gray.astype(np.int32)
+    mag = np.zeros((h, w), dtype=np.uint8)
+    
+    for y in range(1, h - 1):
+        for x in range(1, w - 1):
+            gx = (-g[y-1, x-1] + g[y-1, x+1] -
+                  2*g[y, x-1] + 2*g[y, x+1] -
+                  g[y+1, x-1] + g[y+1, x+1])
+            gy = (-g[y-1, x-1] - 2*g[y-1, x] - g[y-1, x+1] +
+                  g[y+1, x-1] + 2*g[y+1, x] + g[y+1, x+1])
+            
+            mag[y, x] = min(abs(gx) + abs(gy), 255)
+    
+    return mag
+
+
+def dilate_loop(mask, iterations):
+    """
+    形态学膨胀：迭代 iterations 次 8 邻域膨胀，等价于 (2k+1)×(2k+1) 方形结构元
+    先按行、再按列：像素到最近非零像素的距离不超过 k 即置 1
+    """
+    h, w = mask.shape
+    r = iterations
+    rows = np.zeros((h, w), dtype=np.uint8)
+    for y in range(h):
+        last = -r - 1
+        for x in range(w):
+            if mask[y, x] > 0:
+                last = x
+            if x - last <= r:
+                rows[y, x] = 1
+        last = w + r
+        for x in range(w - 1, -1, -1):
+            if mask[y, x] > 0:
+                last = x
+            if last - x <= r:
+                rows[y, x] = 1
+    
+    # 列方向同样处理，按行遍历并为每列记录最近的非零行
+    result = np.zeros((h, w), dtype=np.uint8)
+    last = np.full(w, -r - 1, dtype=np.int64)
+    for y in range(h):
+        for x in range(w):
+            if rows[y, x] > 0:
+                last[x] = y
+            if y - last[x] <= r:
+                result[y, x] = 1
+    last[:] = h + r
+    for y in range(h - 1, -1, -1):
+        for x in range(w):
+            if rows[y, x] > 0:
+                last[x] = y
+            if last[x] - y <= r:
+                result[y, x] = 1
+    
+    return result
+
+
+def halftone_loop(gray, cell, angle_deg, shape, band_y0, band_y1):
+    """
+    旋转晶格半调：逐单元取样求点半径并绘制
+    shape: 0 圆形，1 方形，2 十字
+    只输出 [band_y0, band_y1) 行（取样仍可读整幅 gray），各行带可在线程池中并行计算
+    """
+    h, w = gray.shape
+    binary = np.full((band_y1 - band_y0, w), 255, dtype=np.uint8)  # 白色背景
+    
+    s = max(2, min(60, cell))
+    theta = math.radians(angle_deg)
+    c, si = math.cos(theta), math.sin(theta)
+    cx, cy = w / 2, h / 2
+    
+    # 找到需要覆盖的晶格范围（四个角变换到晶格坐标）
+    i_lo, i_hi, j_lo, j_hi = math.inf, -math.inf, math.inf, -math.inf
+    for corner in range(4):
+        dx = (w if corner % 2 == 1 else 0) - cx
+        dy = (h if corner >= 2 else 0) - cy
+        i = (dx * c + dy * si) / s
+        j = (-dx * si + dy * c) / s
+        i_lo, i_hi = min(i_lo, i), max(i_hi, i)
+        j_lo, j_hi = min(j_lo, j), max(j_hi, j)
+    
+    i_min = math.floor(i_lo) - 1
+    i_max = math.ceil(i_hi) + 1
+    j_min = math.floor(j_lo) - 1
+    j_max = math.ceil(j_hi) + 1
+    
+    offsets = (-0.35, 0.0, 0.35)
+    side_max = s * 0.98
+    
+    for J in range(j_min, j_max + 1):
+        for I in range(i_min, i_max + 1):
+            # 晶格中心
+            center_x = cx + s * ((I + 0.5) * c - (J + 0.5) * si)
+            center_y = cy + s * ((I + 0.5) * si + (J + 0.5) * c)
+            
+            if center_x < -s or center_x > w + s or center_y < -s or center_y > h + s:
+                continue
+            # 点的范围不超过中心上下 s，与本带不相交的单元不必取样
+            if center_y + s < band_y0 or center_y - s > band_y1:
+                continue
+            
+            # 取样周围像素（3×3）
+            sample_sum = 0.0
+            for dv in offsets:
+                for du in offsets:
+                    sx = cx + s * ((I + 0.5 + du) * c - (J + 0.5 + dv) * si)
+                    sy = cy + s * ((I + 0.5 + du) * si + (J + 0.5 + dv) * c)
+                    ix = min(max(round(sx), 0), w - 1)
+                    iy = min(max(round(sy), 0), h - 1)
+                    sample_sum += float(gray[iy, ix])
+            
+            avg = sample_sum / 9
+            darkness = 1 - (avg / 255.0)
+            radius = math.sqrt(max(0.0, darkness)) * (side_max / 2)
+            
+            if radius <= 0.25:
+                continue
+            
+            if shape == 1:
+                # 方形
+                half_side = min(side_max / 2, radius)
+                y0, y1 = max(band_y0, round(center_y - half_side)), min(band_y1, round(center_y + half_side))
+                x0, x1 = max(0, round(center_x - half_side)), min(w, round(center_x + half_side))
+                if y0 < y1 and x0 < x1:
+                    binary[y0 - band_y0:y1 - band_y0, x0:x1] = 0
+            
+            elif shape == 2:
+                # 十字（水平线 + 竖线）
+                length = side_max
+                thick = max(1.0, radius * 0.9)
+                y0, y1 = max(band_y0, int(center_y - thick / 2)), min(band_y1, int(center_y + thick / 2))
+                x0, x1 = max(0, int(center_x - length / 2)), min(w, int(center_x + length / 2))
+                if y0 < y1 and x0 < x1:
+                    binary[y0 - band_y0:y1 - band_y0, x0:x1] = 0
+                y0, y1 = max(band_y0, int(center_y - length / 2)), min(band_y1, int(center_y + length / 2))
+                x0, x1 = max(0, int(center_x - thick / 2)), min(w, int(center_x + thick / 2))
+                if y0 < y1 and x0 < x1:
+                    binary[y0 - band_y0:y1 - band_y0, x0:x1] = 0
+            
+            else:
+                # 圆形
+                radius_sq = radius ** 2
+                for y in range(max(band_y0, int(center_y - radius)), min(band_y1, int(center_y + radius) + 1)):
+                    for x in range(max(0, int(center_x - radius)), min(w, int(center_x + radius) + 1)):
+                        dx = x - center_x
+                        dy = y - center_y
+                        if dx * dx + dy * dy <= radius_sq:
+                            binary[y - band_y0, x] = 0
+    
+    return binary
+
+
+def preview_downsample_loop(binary, ratio):
+    """
+    打印预览的面积平均降采样：窗口均值 > 128 为白(234)，否则为黑(0)
+    """
+    h, w = binary.shape
+    new_w = int(w / ratio)
+    new_h = int(h / ratio)
+    downsampled = np.zeros((new_h, new_w), dtype=np.uint8)
+    
+    for dy in range(new_h):
+        sy0 = math.floor(dy * ratio)
+        sy1 = min(h, math.ceil((dy + 1) * ratio))
+        for dx in range(new_w):
+            sx0 = math.floor(dx * ratio)
+            sx1 = min(w, math.ceil((dx + 1) * ratio))
+            
+            sample_sum = 0
+            for py in range(sy0, sy1):
+                for px in range(sx0, sx1):
+                    sample_sum += int(binary[py, px])
+            
+            count = (sy1 - sy0) * (sx1 - sx0)
+            if sample_sum > 128 * count:
+                downsampled[dy, dx] = 234
+    
+    return downsampled
@@ -0,0 +1,205 @@
+"""
+杯贴处理的分阶段计时
+process_image、generate_print_preview 在各阶段结束时把耗时报告给当前上下文（contextvars）中的接收者；
+未启用计时时接收者为 None，每个阶段只多一次 ContextVar 查询
+"""
+
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# 报告的阶段，及显示用的名称
+STAGES = ('scale', 'grayscale', 'gamma', 'dither', 'edge', 'preview')
+STAGE_LABELS = {
+    'scale': '缩放',
+    'grayscale': '灰度',
+    'gamma': 'Gamma/对比度',
+    'dither': '二值化',
+    'edge': '边缘保护',
+    'preview': '打印预览',
+}
+
+# 直方图各桶的上界（毫秒），超过最后一个上界的计入溢出桶
+HISTOGRAM_BOUNDS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+_sink = contextvars.ContextVar('cup_stage_sink', default=None)
+
+
+def timed(stage: str, fn, *args, **kwargs):
+    """
+    调用 fn 并把耗时报告为 stage；未启用计时时直接调用
+    """
+    sink = _sink.get()
+    if sink is None:
+        return fn(*args, **kwargs)
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    sink(stage, time.perf_counter() - start)
+    return result
+
+
+class StageClock:
+    """
+    按打点计时：每次 lap(阶段) 把距上一次打点（或创建时）的时间报告为该阶段
+    用于交错执行、不便逐段包成函数的阶段（如流式处理的逐带循环）
+    """
+    
+    __slots__ = ('_sink', '_last')
+    
+    def __init__(self, sink):
+        self._sink = sink
+        self._last = time.perf_counter()
+    
+    def lap(self, stage: str):
+        now = time.perf_counter()
+        self._sink(stage, now - self._last)
+        self._last = now
+
+
+def stage_clock() -> StageClock:
+    """从现在开始打点的 StageClock；未启用计时时返回 None"""
+    sink = _sink.get()
+    return StageClock(sink) if sink is not None else None
+
+
+class StageTimings(dict):
+    """
+    各阶段耗时 {阶段: 秒}，同一阶段多次报告时累加（如批量处理的多块）；可从多个线程同时报告
+    """
+    
+    def __init__(self, forward=None):
+        super().__init__()
+        self._forward = forward
+        self._lock = threading.Lock()
+    
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            self[stage] = self.get(stage, 0.0) + seconds
+        if self._forward is not None:
+            self._forward(stage, seconds)
+    
+    @property
+    def total(self) -> float:
+        return sum(self.values())
+    
+    def format(self) -> str:
+        """一行文字，如 "缩放 12ms  灰度 3ms  二值化 20ms  共 35ms"（按 STAGES 的顺序）"""
+        stages = [s for s in STAGES if s in self] + [s for s in self if s not in STAGES]
+        parts = [f"{STAGE_LABELS.get(s, s)} {self[s] * 1000:.0f}ms" for s in stages]
+        return '  '.join(parts + [f"共 {self.total * 1000:.0f}ms"])
+
+
+@contextmanager
+def stage_timings(callback=None):
+    """
+    在 with 块内启用分阶段计时：
+        with stage_timings() as timings:
+            process_image(...)
+    timings 为 StageTimings；给出 callback(阶段, 秒) 时每次报告也转给它（如 StageHistogram.record）
+    嵌套使用时内层的报告同时转给外层，批量任务可在外层汇总、内层看单次渲染
+    接收者只对当前线程（及 contextvars.copy_context() 带过去的线程）可见；行带并行的阶段在调用线程中整体计时
+    """
+    outer = _sink.get()
+    if callback is not None and outer is not None:
+        def forward(stage, seconds):
+            callback(stage, seconds)
+            outer(stage, seconds)
+    else:
+        forward = callback if callback is not None else outer
+    
+    timings = StageTimings(forward)
+    token = _sink.set(timings.record)
+    try:
+        yield timings
+    finally:
+        _sink.reset(token)
+
+
+class StageHistogram:
+    """
+    按阶段汇总多次处理的耗时直方图（批量任务用）
+    record 可直接作为 stage_timings 的 callback，也可用 add 记入一次处理的 StageTimings；
+    多进程任务各进程的直方图可 pickle 回主进程后 merge
+    """
+    
+    def __init__(self, bounds_ms: tuple = HISTOGRAM_BOUNDS_MS):
+        self.bounds = tuple(b / 1000 for b in bounds_ms)  # 秒
+        self.counts = {}   # 阶段 -> 各桶次数（最后一个为溢出桶）
+        self.totals = {}   # 阶段 -> 总秒数
+        self.maxima = {}   # 阶段 -> 最长一次的秒数
+        self._lock = threading.Lock()
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+    
+    def _bins(self, stage: str) -> list:
+        counts = self.counts.get(stage)
+        if counts is None:
+            counts = self.counts[stage] = [0] * (len(self.bounds) + 1)
+            self.totals[stage] = 0.0
+            self.maxima[stage] = 0.0
+        return counts
+    
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            self._bins(stage)[bisect.bisect_left(self.bounds, seconds)] += 1
+            self.totals[stage] += seconds
+            self.maxima[stage] = max(self.maxima[stage], seconds)
+    
+    def add(self, timings: dict):
+        """记入一次处理的 {阶段: 秒}"""
+        for stage, seconds in timings.items():
+            self.record(stage, seconds)
+    
+    def merge(self, other: 'StageHistogram'):
+        """并入另一个桶界相同的直方图"""
+        if other.bounds != self.bounds:
+            raise ValueError("直方图的桶界不同，无法合并")
+        with self._lock:
+            for stage, counts in other.counts.items():
+                bins = self._bins(stage)
+                for i, n in enumerate(counts):
+                    bins[i] += n
+                self.totals[stage] += other.totals[stage]
+                self.maxima[stage] = max(self.maxima[stage], other.maxima[stage])
+    
+    def quantile(self, stage: str, q: float) -> float:
+        """按桶估计的分位数（秒）：取所在桶的上界，落在溢出桶时取最大值"""
+        counts = self.counts[stage]
+        rank = q * sum(counts)
+        seen = 0
+        for i, n in enumerate(counts[:-1]):
+            seen += n
+            if n and seen >= rank:
+                return min(self.bounds[i], self.maxima[stage])
+        return self.maxima[stage]
+    
+    def summary(self) -> dict:
+        """{阶段: {count, mean, p50, p95, max}}，时间单位为秒，阶段按 STAGES 的顺序"""
+        stages = [s for s in STAGES if s in self.counts] + [s for s in self.counts if s not in STAGES]
+        result = {}
+        for stage in stages:
+            count = sum(self.counts[stage])
+            result[stage] = dict(count=count, mean=self.totals[stage] / count,
+                                 p50=self.quantile(stage, 0.5), p95=self.quantile(stage, 0.95),
+                                 max=self.maxima[stage])
+        return result
+    
+    def format(self) -> str:
+        """文字表格：每个阶段一行（次数、均值、p50、p95、最大，毫秒）及各桶的次数"""
+        edges = [f"≤{b * 1000:g}" for b in self.bounds] + ['更长']
+        lines = [f"{'阶段':<10}{'次数':>6}{'均值':>9}{'p50':>9}{'p95':>9}{'最大':>9}  各桶次数(ms): "
+                 + ' '.join(edges)]
+        for stage, s in self.summary().items():
+            bins = ' '.join(str(n) for n in self.counts[stage])
+            lines.append(f"{stage:<10}{s['count']:>6}{s['mean'] * 1000:>9.1f}{s['p50'] * 1000:>9.1f}"
+                         f"{s['p95'] * 1000:>9.1f}{s['max'] * 1000:>9.1f}  {bins}")
+        return '\n'.join(lines)
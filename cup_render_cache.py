@@ -0,0 +1,211 @@
+"""
+杯贴渲染结果的磁盘缓存
+以源图内容哈希 + 全部处理参数的规范化哈希为键，保存 1 位打包的二值结果和打印预览，
+超过容量上限时按最近使用时间淘汰
+"""
+
+import hashlib
+import json
+import os
+import sys
+import zipfile
+
+import numpy as np
+from PIL import Image
+
+from cup_image_processor import PackedSticker, SourcePyramid
+
+# 处理算法变化导致输出不同时递增，使旧缓存失效
+CACHE_VERSION = 1
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+# 淘汰时降到上限的这个比例，之后的若干次写入不必每次都扫描整个目录
+EVICT_LOW_WATER = 0.9
+
+
+def default_cache_dir() -> str:
+    """
+    各平台的用户缓存目录
+    """
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'HeyTea_AutoUpload', 'renders')
+
+
+def source_digest(image) -> str:
+    """
+    源图内容哈希（模式 + 尺寸 + 像素），结果记在 image.info 中避免重复计算
+    image 可以是 PIL 图像或 SourcePyramid（取第 0 级）
+    """
+    digest = image.info.get('content_digest')
+    if digest is None:
+        base = image.levels[0] if isinstance(image, SourcePyramid) else image
+        h = hashlib.blake2b(digest_size=20)
+        h.update(f"{base.mode}:{base.size[0]}x{base.size[1]}:".encode())
+        h.update(base.tobytes())
+        digest = h.hexdigest()
+        image.info['content_digest'] = digest
+    return digest
+
+
+def params_digest(params: dict) -> str:
+    """
+    处理参数的规范化哈希（键排序，浮点数用 repr 保证精确）
+    """
+    canonical = {k: repr(v) if isinstance(v, float) else v for k, v in params.items()}
+    text = json.dumps(canonical, sort_keys=True, separators=(',', ':'))
+    return hashlib.blake2b(text.encode(), digest_size=20).hexdigest()
+
+
+class RenderCache:
+    """
+    磁盘渲染缓存
+    每个条目为 <key>.npz（打包的二值结果及缩放信息），可附带 <key>.png（打印预览）；
+    命中时更新文件修改时间，超过 max_bytes 时删除最久未使用的文件（降到 max_bytes 的 EVICT_LOW_WATER）；
+    损坏的条目按未命中处理并删除
+    """
+
+    def __init__(self, directory: str = None, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+        self._total_bytes = sum(size for _, _, size in self._entries())
+
+    def key_for(self, image, params: dict) -> str:
+        """
+        缓存键：源图内容哈希 + 参数哈希
+        """
+        params = dict(params, _version=CACHE_VERSION)
+        return f"{source_digest(image)}-{params_digest(params)}"
+
+    def _path(self, key: str, ext: str) -> str:
+        return os.path.join(self.directory, key + ext)
+
+    def _entries(self) -> list:
+        """(路径, 修改时间, 大小) 列表"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(('.npz', '.png')):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, st.st_mtime, st.st_size))
+        return entries
+
+    def _touch(self, path: str):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _write(self, path: str, write):
+        """写入临时文件后原子替换，并按需淘汰"""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            write(f)
+        # 覆盖已有条目时先扣除旧文件的大小
+        try:
+            old_size = os.path.getsize(path)
+        except OSError:
+            old_size = 0
+        os.replace(tmp_path, path)
+        self._total_bytes += os.path.getsize(path) - old_size
+        if self._total_bytes > self.max_bytes:
+            self.evict()
+
+    def _discard(self, path: str):
+        """删除损坏的条目"""
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        self._total_bytes -= size
+
+    def evict(self):
+        """
+        按最近使用时间从旧到新删除，直到总大小不超过上限的 EVICT_LOW_WATER
+        """
+        entries = sorted(self._entries(), key=lambda e: e[1])
+        total = sum(size for _, _, size in entries)
+        target = int(self.max_bytes * EVICT_LOW_WATER)
+        for path, _, size in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._total_bytes = total
+
+    def get(self, key: str):
+        """
+        读取二值结果，返回 (PackedSticker, 原始宽度, 原始高度, 实际缩放比例)，未命中返回 None
+        """
+        path = self._path(key, '.npz')
+        try:
+            with np.load(path) as data:
+                sticker = PackedSticker(data['bits'], int(data['width']))
+                meta = (int(data['orig_w']), int(data['orig_h']), float(data['real_scale']))
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+            # 写入中断等原因损坏的文件：按未命中处理并删除，下次重新计算后写回
+            self.misses += 1
+            self._discard(path)
+            return None
+
+        self.hits += 1
+        self._touch(path)
+        return (sticker,) + meta
+
+    def put(self, key: str, sticker: PackedSticker, orig_w: int, orig_h: int, real_scale: float):
+        """
+        保存二值结果
+        """
+        self._write(self._path(key, '.npz'), lambda f: np.savez(
+            f, bits=sticker.bits, width=sticker.width,
+            orig_w=orig_w, orig_h=orig_h, real_scale=real_scale))
+
+    def get_preview(self, key: str) -> Image.Image:
+        """
+        读取打印预览，未命中返回 None
+        """
+        path = self._path(key, '.png')
+        try:
+            with Image.open(path) as im:
+                im.load()
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, SyntaxError, ValueError):
+            self._discard(path)
+            return None
+
+        self._touch(path)
+        return im
+
+    def put_preview(self, key: str, preview: Image.Image):
+        """
+        保存打印预览
+        """
+        self._write(self._path(key, '.png'), lambda f: preview.save(f, 'PNG'))
+
+    def clear(self):
+        """删除全部缓存文件"""
+        for path, _, _ in self._entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._total_bytes = 0
@@ -5,6 +5,7 @@ import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
 from PIL import Image, ImageTk
 import threading
+import multiprocessing
 from heytea_api_config import *
 import requests
 import json
@@ -12,7 +13,12 @@ import os
 import sys
 import subprocess
 import numpy as np
-from cup_image_processor import process_image, generate_print_preview
+from cup_image_processor import (process_image, auto_render, generate_print_preview, RenderPipeline,
+                                 load_source_image, SourcePyramid,
+                                 MIN_SCALE_PERCENT, MAX_SCALE_PERCENT)
+from cup_render_cache import RenderCache
+from cup_contact_sheet import render_contact_sheet
+from cup_profiling import StageTimings, stage_timings
 
 # 版本号：从环境变量读取（打包时注入），否则显示git commit hash
 def get_version():
@@ -305,6 +311,14 @@ class HeyTeaUploader:
         self.cup_current_file = None
         self.cup_current_image = None
         self.cup_render_timer = None
+        self.cup_render_token = 0  # 每次渲染递增，后台完成的旧结果据此丢弃
+        self.cup_auto_busy = False  # 自动模式是否正在后台渲染
+        self.cup_auto_request = None  # 后台渲染期间到来的最新自动模式请求 (token, params)
+        self.cup_pipeline = RenderPipeline()  # 各处理阶段的缓存
+        try:
+            self.cup_render_cache = RenderCache()  # 磁盘渲染缓存
+        except OSError:
+            self.cup_render_cache = None
         self.cup_canvas_images = {}  # 缓存PhotoImage对象
         
         self.create_widgets()
@@ -556,7 +570,7 @@ class HeyTeaUploader:
         ttk.Label(mode_frame, text="处理模式:").pack(side='left')
         self.cup_mode_var = tk.StringVar(value="circle")
         mode_combo = ttk.Combobox(mode_frame, textvariable=self.cup_mode_var, 
-                                   values=["circle", "bayer", "fs"], state='readonly', width=15)
+                                   values=["auto", "circle", "bayer", "bayer4", "bayer16", "bayer32", "bluenoise", "fs", "atkinson", "jarvis", "stucki", "sierra"], state='readonly', width=15)
         mode_combo.pack(side='right', fill='x', expand=True)
         mode_combo.bind('<<ComboboxSelected>>', lambda e: self.cup_schedule_render())
         
@@ -567,7 +581,7 @@ class HeyTeaUploader:
         self.cup_scale_var = tk.IntVar(value=100)
         self.cup_scale_label = ttk.Label(scale_frame, text="100")
         self.cup_scale_label.pack(side='right', padx=(5, 0))
-        scale_slider = ttk.Scale(scale_frame, from_=25, to=300, orient='horizontal',
+        scale_slider = ttk.Scale(scale_frame, from_=MIN_SCALE_PERCENT, to=MAX_SCALE_PERCENT, orient='horizontal',
                                  variable=self.cup_scale_var, command=lambda v: self.cup_update_scale_label())
         scale_slider.pack(side='right', fill='x', expand=True, padx=(0, 5))
         scale_slider.bind('<B1-Motion>', lambda e: self.cup_schedule_render())
@@ -691,8 +705,17 @@ class HeyTeaUploader:
                                         command=self.cup_export_image, state='disabled')
         self.cup_export_btn.pack(side='right', padx=(5, 0))
         
+        self.cup_sheet_btn = ttk.Button(button_frame, text="参数对比图",
+                                       command=self.cup_export_contact_sheet, state='disabled')
+        self.cup_sheet_btn.pack(side='right', padx=(5, 0))
+        
         self.cup_clear_btn = ttk.Button(button_frame, text="清空", command=self.cup_clear)
         self.cup_clear_btn.pack(side='right')
+        
+        # 状态栏（显示自动模式的选择结果、上次渲染各阶段的耗时等）
+        self.cup_status_label = ttk.Label(button_frame, text="", foreground="gray",
+                                          justify='left', wraplength=int(320 * self.scale_factor))
+        self.cup_status_label.pack(side='left')
     
     def cup_select_image(self):
         """选择杯贴图片"""
@@ -704,9 +727,13 @@ class HeyTeaUploader:
         if file_path:
             try:
                 self.cup_current_file = file_path
-                self.cup_current_image = Image.open(file_path)
+                # 解码时即缩小到够用的尺寸，并应用EXIF方向；再建好缩放用的金字塔
+                source = load_source_image(file_path, 596, 832, MAX_SCALE_PERCENT)
+                self.cup_current_image = SourcePyramid(source, 596, 832, MIN_SCALE_PERCENT)
+                self.cup_pipeline.clear()
                 self.cup_file_label.config(text=f"已选择: {os.path.basename(file_path)}", foreground="#000")
                 self.cup_export_btn.config(state='normal')
+                self.cup_sheet_btn.config(state='normal')
                 self.cup_schedule_render()
             except Exception as e:
                 messagebox.showerror("错误", f"无法打开图片: {e}")
@@ -745,64 +772,142 @@ class HeyTeaUploader:
         
         self.cup_render_timer = self.root.after(300, self.cup_render)
     
+    def cup_render_params(self) -> dict:
+        """当前界面上的处理参数"""
+        return dict(
+            mode=self.cup_mode_var.get(),
+            canvas_width=596,
+            canvas_height=832,
+            scale_percent=self.cup_scale_var.get(),
+            grid_size=self.cup_grid_var.get(),
+            shape=self.cup_shape_var.get(),
+            angle=self.cup_angle_var.get(),
+            gamma=self.cup_gamma_var.get(),
+            contrast=self.cup_contrast_var.get(),
+            edge_protect=self.cup_edge_var.get(),
+            lo_threshold=self.cup_lo_var.get(),
+            hi_threshold=120,
+            tau_threshold=60,
+            dilate_iters=0,
+            fs_serpentine=True
+        )
+    
     def cup_render(self):
         """渲染图像预览"""
         if not self.cup_current_image:
             return
         
+        self.cup_render_token += 1
         try:
-            # 处理图像
-            binary_array, orig_w, orig_h, real_scale = process_image(
-                self.cup_current_image,
-                mode=self.cup_mode_var.get(),
-                canvas_width=596,
-                canvas_height=832,
-                scale_percent=self.cup_scale_var.get(),
-                grid_size=self.cup_grid_var.get(),
-                shape=self.cup_shape_var.get(),
-                angle=self.cup_angle_var.get(),
-                gamma=self.cup_gamma_var.get(),
-                contrast=self.cup_contrast_var.get(),
-                edge_protect=self.cup_edge_var.get(),
-                lo_threshold=self.cup_lo_var.get(),
-                hi_threshold=120,
-                tau_threshold=60,
-                dilate_iters=0,
-                fs_serpentine=True
-            )
-            
-            # 转换为PIL图像用于显示
-            binary_img = Image.fromarray(binary_array, 'L')
-            
-            # 主预览框：缩放到300x400（对应Canvas宽高）
-            # 保持596:832的比例 -> 300:400
-            binary_img_display = binary_img.resize((300, 400), Image.Resampling.LANCZOS)
-            
-            # 转为PhotoImage
-            photo = ImageTk.PhotoImage(binary_img_display)
-            self.cup_canvas_images['main'] = photo
-            self.cup_preview_canvas.itemconfig(self.cup_canvas_item, image=photo)
-            
-            # 生成打印预览（最终效果 - 360x760的标签模拟）
-            print_preview = generate_print_preview(binary_array)
+            # 处理参数（同时用作磁盘缓存的键）
+            params = self.cup_render_params()
             
-            # 打印预览框：缩放到180x380（对应Canvas宽高）
-            # 保持360:760的比例 -> 180:380
-            print_preview_display = print_preview.resize((180, 380), Image.Resampling.LANCZOS)
+            # 自动模式要跑满时间预算，放到后台线程，完成后再回到界面线程显示
+            if params['mode'] == 'auto':
+                self.cup_auto_request = (self.cup_render_token, params)
+                if not self.cup_auto_busy:
+                    self.cup_run_auto()
+                return
             
-            # 转为PhotoImage
-            print_photo = ImageTk.PhotoImage(print_preview_display)
-            self.cup_canvas_images['print'] = print_photo
-            self.cup_print_canvas.itemconfig(self.cup_print_item, image=print_photo)
+            # 各阶段耗时（缩放、灰度、Gamma/对比度、二值化、边缘保护、打印预览），渲染完显示在状态栏
+            timings = StageTimings()
             
-            # 存储处理后的二值化图像供导出使用
-            self.cup_processed_binary = binary_img
+            # 处理图像（先查磁盘缓存）
+            sticker, orig_w, orig_h, real_scale = process_image(
+                self.cup_current_image,
+                **params,
+                pipeline=self.cup_pipeline,
+                packed=True,
+                cache=self.cup_render_cache,
+                timings=timings.record
+            )
+            self.cup_show_render(sticker, params, self.cup_render_cache, "", timings)
             
         except Exception as e:
             messagebox.showerror("错误", f"处理图像失败: {e}")
             import traceback
             traceback.print_exc()
     
+    def cup_run_auto(self):
+        """在后台线程执行最新的自动模式请求（同一时间只有一个，期间到来的请求只保留最新的）"""
+        token, params = self.cup_auto_request
+        self.cup_auto_request = None
+        self.cup_auto_busy = True
+        self.cup_status_label.config(text="自动选择中...")
+        # 画布在界面线程从共用的缩放缓存中取出，后台线程只读这份数组
+        _, scaled = self.cup_pipeline.scale(self.cup_current_image, params['canvas_width'],
+                                            params['canvas_height'], params['scale_percent'])
+        # 自动模式挑选模式与形状
+        auto_params = {k: v for k, v in params.items() if k not in ('mode', 'shape')}
+        
+        def work():
+            timings = StageTimings()
+            try:
+                with stage_timings(timings.record):
+                    result = auto_render(None, **auto_params, scaled=scaled)
+                error = None
+            except Exception as e:
+                import traceback
+                traceback.print_exc()
+                result, error = None, str(e)
+            self.root.after(0, lambda: self.cup_finish_auto(token, params, result, error, timings))
+        
+        threading.Thread(target=work, daemon=True).start()
+    
+    def cup_finish_auto(self, token, params, result, error, timings):
+        """界面线程：显示自动模式的结果（已有更新的渲染时丢弃），再处理等待中的请求"""
+        self.cup_auto_busy = False
+        if token == self.cup_render_token:
+            try:
+                if error is not None:
+                    raise RuntimeError(error)
+                sticker, orig_w, orig_h, real_scale, choice = result
+                mode_name = choice['mode'] if choice['mode'] != 'circle' else choice['shape']
+                status = (f"自动选择: {mode_name}  Gamma {choice['gamma']:.2f}  对比度 {choice['contrast']}"
+                          f"  (已评估 {choice['scored']}/{choice['total']})\n")
+                # 自动模式的结果取决于时间预算内完成了哪些候选，不走磁盘缓存
+                self.cup_show_render(sticker, params, None, status, timings)
+            except Exception as e:
+                messagebox.showerror("错误", f"处理图像失败: {e}")
+        
+        if self.cup_auto_request is not None:
+            self.cup_run_auto()
+    
+    def cup_show_render(self, sticker, params, render_cache, status, timings):
+        """显示渲染结果：主预览、打印预览（先查磁盘缓存）和状态栏中的各阶段耗时"""
+        # 主预览框：缩放到300x400（对应Canvas宽高）
+        # 保持596:832的比例 -> 300:400（'1' 模式只能最近邻缩放，先转为灰度）
+        binary_img_display = sticker.to_image().convert('L').resize((300, 400), Image.Resampling.LANCZOS)
+        
+        # 转为PhotoImage
+        photo = ImageTk.PhotoImage(binary_img_display)
+        self.cup_canvas_images['main'] = photo
+        self.cup_preview_canvas.itemconfig(self.cup_canvas_item, image=photo)
+        
+        # 生成打印预览（最终效果 - 360x760的标签模拟），同样先查磁盘缓存
+        print_preview = None
+        if render_cache:
+            cache_key = render_cache.key_for(self.cup_current_image, params)
+            print_preview = render_cache.get_preview(cache_key)
+        if print_preview is None:
+            with stage_timings(timings.record):
+                print_preview = generate_print_preview(sticker)
+            if render_cache:
+                render_cache.put_preview(cache_key, print_preview)
+        self.cup_status_label.config(text=status + (timings.format() if timings else "已命中缓存"))
+        
+        # 打印预览框：缩放到180x380（对应Canvas宽高）
+        # 保持360:760的比例 -> 180:380
+        print_preview_display = print_preview.resize((180, 380), Image.Resampling.LANCZOS)
+        
+        # 转为PhotoImage
+        print_photo = ImageTk.PhotoImage(print_preview_display)
+        self.cup_canvas_images['print'] = print_photo
+        self.cup_print_canvas.itemconfig(self.cup_print_item, image=print_photo)
+        
+        # 存储处理后的二值化结果（1位打包）供导出使用
+        self.cup_processed_binary = sticker
+    
     def cup_export_image(self):
         """导出成品PNG - 导出最后修改的处理结果"""
         if not hasattr(self, 'cup_processed_binary') or self.cup_processed_binary is None:
@@ -826,20 +931,86 @@ class HeyTeaUploader:
         
         if file_path:
             try:
-                # 导出当前处理后的二值化图像
-                self.cup_processed_binary.save(file_path, 'PNG')
+                # 导出当前处理后的二值化图像：内部以 1 位打包保存，导出的文件要上传到喜茶，
+                # 仍按原来的 8 位灰度（'L'）PNG 保存，未确认接口接受 1 位 PNG 前不改格式
+                self.cup_processed_binary.to_image().convert('L').save(file_path, 'PNG')
                 messagebox.showinfo("导出成功", f"图片已保存到:\n{file_path}\n\n图片尺寸: 596×832 像素")
             except Exception as e:
                 messagebox.showerror("导出失败", f"保存失败: {e}")
     
+    def cup_export_contact_sheet(self):
+        """以当前参数为中心扫描一组参数，导出对比图"""
+        if not self.cup_current_image:
+            messagebox.showwarning("提示", "请先选择图片")
+            return
+        
+        params = self.cup_render_params()
+        if params['mode'] == 'auto':
+            messagebox.showwarning("提示", "自动模式不支持参数扫描，请先选择具体的处理模式")
+            return
+        
+        # Gamma、对比度总是扫描；网格大小和角度只对半调模式有效，更黑阈值只在边缘保护开启时有效
+        def around(value, step, lo, hi):
+            return list(dict.fromkeys(min(hi, max(lo, value + d)) for d in (-step, 0, step)))
+        
+        gamma = params['gamma']
+        ranges = {
+            'gamma': [round(gamma * f, 2) for f in (0.8, 1.0, 1.25)],
+            'contrast': around(params['contrast'], 20, -100, 100),
+        }
+        if params['mode'] in ('circle', 'square', 'cross'):
+            ranges['grid_size'] = around(params['grid_size'], 2, 2, 16)
+            ranges['angle'] = around(params['angle'], 15, 0, 90)
+        if params['edge_protect']:
+            ranges['lo_threshold'] = around(params['lo_threshold'], 20, 0, 255)
+        
+        source_filename = os.path.splitext(os.path.basename(self.cup_current_file))[0]
+        file_path = filedialog.asksaveasfilename(
+            title="导出参数对比图",
+            defaultextension=".png",
+            filetypes=[("PNG文件", "*.png"), ("所有文件", "*.*")],
+            initialfile=f"{source_filename}_sweep.png"
+        )
+        if not file_path:
+            return
+        
+        self.cup_sheet_btn.config(state='disabled')
+        self.cup_status_label.config(text="正在生成参数对比图...")
+        # 在界面线程中取缩放好的画布（多半命中阶段缓存），后台线程不与 cup_render 同时缩放同一张源图
+        _, (canvas, _, _, _) = self.cup_pipeline.scale(
+            self.cup_current_image, params['canvas_width'], params['canvas_height'], params['scale_percent'])
+        
+        def work():
+            try:
+                sheet, combos = render_contact_sheet(None, params, ranges, canvas=canvas)
+                sheet.save(file_path, 'PNG')
+                done = lambda: messagebox.showinfo("导出成功", f"参数对比图（{len(combos)} 组）已保存到:\n{file_path}")
+            except Exception as e:
+                message = f"生成参数对比图失败: {e}"
+                done = lambda: messagebox.showerror("导出失败", message)
+            
+            def finish():
+                self.cup_status_label.config(text="")
+                if self.cup_current_image:
+                    self.cup_sheet_btn.config(state='normal')
+                done()
+            self.root.after(0, finish)
+        
+        threading.Thread(target=work, daemon=True).start()
+    
     def cup_clear(self):
         """清空杯贴数据"""
         self.cup_current_file = None
         self.cup_current_image = None
+        self.cup_render_token += 1  # 丢弃后台尚未完成的渲染
+        self.cup_auto_request = None
+        self.cup_pipeline.clear()
         self.cup_file_label.config(text="点击选择文件或拖放", foreground="#999")
         self.cup_preview_canvas.delete('all')
         self.cup_print_canvas.delete('all')
         self.cup_export_btn.config(state='disabled')
+        self.cup_sheet_btn.config(state='disabled')
+        self.cup_status_label.config(text="")
         if hasattr(self, 'cup_processed_binary'):
             self.cup_processed_binary = None
 
@@ -1309,4 +1480,6 @@ def main():
 
 
 if __name__ == "__main__":
+    # 打包后的程序启动参数对比图的工作进程时需要
+    multiprocessing.freeze_support()
     main()